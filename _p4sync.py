@@ -1,22 +1,46 @@
 #!/usr/bin/env python3
 
 import lib
-lib.Lib.check()
 
-import os.path
 import sys
+import argparse
 from git import Git
-from repostat import Stat
+from manifest import Project
 
-s = Stat(False, False)
 
-rev = s.git.run(['ls-remote', '--exit-code', s.remote, 'refs/remotes/p4/master']).stdout.split(maxsplit=1)[0]
+kP4Master = 'refs/remotes/p4/master'
+kP4Head = 'refs/remotes/p4/HEAD'
 
-remote_dir = os.path.join(s.git.dir, '.git/refs/remotes/p4')
-os.makedirs(remote_dir, exist_ok=True)
 
-open(os.path.join(remote_dir, 'HEAD'), 'w').write('ref: refs/remotes/p4/master\n')
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	return parser.parse_args(argv)
 
-with open(os.path.join(remote_dir, 'master'), 'w') as f:
-	f.write(rev)
-	f.write('\n')
+
+def run(project, args, out=sys.stdout, err=sys.stderr):
+	git = Git(project.dir, direct=True)
+
+	rev = git.run(['ls-remote', '--exit-code', project.remote, kP4Master]).stdout.split(maxsplit=1)[0]
+
+	commands = []
+	if not git.exists(kP4Master) or git.commitId(kP4Master) != rev:
+		commands.append(f'update {kP4Master} {rev}\n')
+
+	headOutdated = git.symbolicRef(kP4Head) != kP4Master
+	if headOutdated and Git.version() >= (2, 46):
+		commands.append(f'symref-update {kP4Head} {kP4Master}\n')
+		headOutdated = False
+
+	# a single transaction, nothing is written when the mirror did not move
+	if commands:
+		git.run(['update-ref', '--stdin'], input='start\n' + ''.join(commands) + 'prepare\ncommit\n')
+
+	# git before 2.46 cannot update symbolic refs in a transaction, p4/HEAD
+	# is then set on its own, after p4/master exists
+	if headOutdated:
+		git.run(['symbolic-ref', kP4Head, kP4Master])
+
+
+if __name__ == '__main__':
+	lib.Lib.check()
+	sys.exit(run(Project.fromEnv(), parse_args()))
@@ -2,54 +2,85 @@
 
 import argparse
 from repostat import Stat
+from manifest import Project
 import colorize
+import subprocess
 import sys
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--dry-run', dest='dry_run', action='store_true')
-parser.add_argument('--remote')
-parser.add_argument('command', choices=['push', 'pull'])
-parser.add_argument('branch')
-args = parser.parse_args()
 
-s = Stat()
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--dry-run', dest='dry_run', action='store_true')
+	parser.add_argument('--remote')
+	parser.add_argument('command', choices=['push', 'pull'])
+	parser.add_argument('branch')
+	return parser.parse_args(argv)
 
-remote = args.remote if args.remote else s.remote
-remote_branch = 'refs/sandbox/' + args.branch
 
-try:
-	s.git.run(['fetch', s.remote, remote_branch], color=False)
-	has_fetch = True
-except:
-	has_fetch = False
+def run(project, args, out=sys.stdout, err=sys.stderr):
+	s = Stat(project=project)
 
-if args.command == 'push':
-	commits = s.git.run(['log', '--oneline', '--format=%H', 'FETCH_HEAD..HEAD'], color=False) \
-		.stdout.splitlines() if has_fetch else s.commits
+	remote = args.remote if args.remote else s.remote
+	remote_branch = 'refs/sandbox/' + args.branch
 
-	number_of_commits = len(commits)
+	# ask the remote where the sandbox branch is before fetching anything,
+	# an unreachable remote counts as one without the branch
+	try:
+		lines = s.git.run(['ls-remote', remote, remote_branch], color=False).stdout.split()
+	except subprocess.CalledProcessError:
+		lines = []
+	sandbox_rev = lines[0] if lines else None
+	head_rev = s.git.commitId('HEAD')
 
-	if commits:
-		print(colorize.c(s.path, bright=True) + ': ', end='')
-		commits_message = str(number_of_commits) + ' commit' + ('s' if number_of_commits > 1 else '')
-		if args.dry_run:
-			print('Would push {} into remote={} branch={}'.format(commits_message,
-					remote, remote_branch))
+	def count(rev_range):
+		return int(s.git.run(['rev-list', '--count', rev_range], color=False).stdout)
+
+	def fetch_sandbox():
+		# the sandbox commits may already be here from an earlier pull
+		if s.git.exists(sandbox_rev):
+			return True
+		try:
+			s.git.run(['fetch', remote, remote_branch], color=False)
+			return True
+		except subprocess.CalledProcessError:
+			return False
+
+	if sandbox_rev is not None and sandbox_rev != head_rev and not fetch_sandbox():
+		sandbox_rev = None
+
+	if args.command == 'push':
+		if sandbox_rev == head_rev:
+			return
+		if sandbox_rev is None:
+			number_of_commits = len(s.commits or [])
 		else:
-			s.git.run(['push', remote, 'HEAD:' + remote_branch])
-			print(colorize.c('Pushed ' + commits_message, color=colorize.GREEN, bright=True))
-elif args.command == 'pull':
-	if has_fetch:
-		commits = s.git.run(['log', '--oneline', '--format=%H', 'HEAD..FETCH_HEAD'], color=False).stdout.splitlines()
-
-		if commits:
-			print(colorize.c(s.path, bright=True) + ': ', end='')
+			number_of_commits = count(sandbox_rev + '..HEAD')
+
+		if number_of_commits:
+			print(colorize.c(s.path, bright=True) + ': ', end='', file=out)
+			commits_message = str(number_of_commits) + ' commit' + ('s' if number_of_commits > 1 else '')
+			if args.dry_run:
+				print('Would push {} into remote={} branch={}'.format(commits_message,
+						remote, remote_branch), file=out)
+			else:
+				s.git.run(['push', remote, 'HEAD:' + remote_branch])
+				print(colorize.c('Pushed ' + commits_message, color=colorize.GREEN, bright=True), file=out)
+	elif args.command == 'pull':
+		if sandbox_rev is None or sandbox_rev == head_rev:
+			return
+
+		if count('HEAD..' + sandbox_rev):
+			print(colorize.c(s.path, bright=True) + ': ', end='', file=out)
 			if s.commits and (s.dirty_files or not s.branch_name):
-				print('Cannot switch to sandbox branch because project is dirty')
-				sys.exit(1)
+				print('Cannot switch to sandbox branch because project is dirty', file=out)
+				return 1
 
 			if args.dry_run:
-				print('Would checkout')
+				print('Would checkout', file=out)
 			else:
-				s.git.run(['checkout', 'FETCH_HEAD'], color=False)
-				print('DONE')
+				s.git.run(['checkout', sandbox_rev], color=False)
+				print('DONE', file=out)
+
+
+if __name__ == '__main__':
+	sys.exit(run(Project.fromEnv(), parse_args()))
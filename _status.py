@@ -1,26 +1,90 @@
 #!/usr/bin/env python3
 
 import lib
-lib.Lib.check()
 
 import os
+import re
 import sys
+import json
 import argparse
+import threading
 
 import subprocess
 import colorize
 from repostat import Stat
+from manifest import Project
 
 
-def main():
+kColorRe = re.compile(r'\033\[[0-9;]*m')
+
+
+class Summary:
+	# workspace totals, accumulated by concurrent runs and printed last
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = dict(projects=0, failed=0, dirty=0, detached=0, untracked=0, hacked=0, missing_rrev=0,
+				ahead=0, commits=0, do_not_merge=0)
+
+	def add(self, record):
+		with self.lock:
+			self.counts['projects'] += 1
+			self.counts['dirty'] += bool(record['dirty_files'])
+			self.counts['detached'] += not record['branch']
+			self.counts['untracked'] += bool(record['branch']) and not record['tracking']
+			self.counts['hacked'] += bool(record['do_not_merge'])
+			self.counts['missing_rrev'] += record['missing_rrev']
+			self.counts['ahead'] += bool(record['commits'])
+			self.counts['commits'] += len(record['commits'])
+			self.counts['do_not_merge'] += len(record['do_not_merge'])
+
+	def fail(self):
+		with self.lock:
+			self.counts['failed'] += 1
+
+	def record(self):
+		with self.lock:
+			return dict(type='summary', **self.counts)
+
+
+def parse_args(argv=None):
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-d', action='store_true', default=False)
-	args = parser.parse_args()
+	parser.add_argument('--format', choices=['text', 'json'], default='text')
+	args = parser.parse_args(argv)
+	args.summary = Summary() if args.format == 'json' else None
+	return args
+
+
+def make_record(s):
+	commits = s.commits or []
+	return dict(
+		type='project',
+		path=s.path,
+		branch=s.branch_name,
+		tracking=s.is_tracking,
+		dirty_files=[kColorRe.sub('', f) for f in s.dirty_files],
+		commits=[dict(hash=c.hash, subject=c.subject) for c in commits],
+		do_not_merge=[c.hash for c in commits if not Stat.do_not_merge_filter(c)],
+		missing_rrev=bool(s.no_remote_revision),
+	)
+
 
-	s = Stat(merges=False)
+def print_json(record, out):
+	print(json.dumps(record, separators=(',', ':')), file=out)
+
+
+def run(project, args, out=sys.stdout, err=sys.stderr):
+	s = Stat(merges=False, project=project)
+
+	if args.format == 'json':
+		record = make_record(s)
+		if args.summary:
+			args.summary.add(record)
+		print_json(record, out)
+		return
 
 	if not s.has_info:
-		sys.exit()
+		return
 
 	tags = []
 	if s.no_remote_revision:
@@ -34,19 +98,19 @@ def main():
 	if s.filtered_revs:
 		tags.append('HACKED')
 
-	print(colorize.c(s.path, bright=True), end='')
+	print(colorize.c(s.path, bright=True), end='', file=out)
 	if s.branch_name:
-		print(' ' + colorize.c('({})'.format(s.branch_name), color=colorize.GREEN), end='')
+		print(' ' + colorize.c('({})'.format(s.branch_name), color=colorize.GREEN), end='', file=out)
 	if tags:
-		print(' ' + ' '.join(colorize.c('[{}]'.format(tag), color=colorize.RED, bright=True) for tag in tags), end='')
-	print()
+		print(' ' + ' '.join(colorize.c('[{}]'.format(tag), color=colorize.RED, bright=True) for tag in tags), end='', file=out)
+	print(file=out)
 
 	if s.no_remote_revision:
-		print(f'ERROR: Missing manifest revision: rmeote: {s.remote} revision: {s.rrev}')
+		print(f'ERROR: Missing manifest revision: rmeote: {s.remote} revision: {s.rrev}', file=out)
 
 	if s.dirty_files:
 		for dirty_file in s.dirty_files:
-			print(dirty_file)
+			print(dirty_file, file=out)
 
 	if not s.commits is None:
 		for c in s.commits:
@@ -57,9 +121,32 @@ def main():
 					+ c.subject[len(Stat.DO_NOT_MERGE_PREFIX):]
 			else:
 				subject = c.subject
-			print('{} {}'.format(colorize.c(c.hash[:7], color=colorize.YELLOW), subject))
+			print('{} {}'.format(colorize.c(c.hash[:7], color=colorize.YELLOW), subject), file=out)
+
+	print(file=out)
+
 
-	print()
+def fail(project, args, message, out=sys.stdout):
+	# keeps the json stream parseable when a project cannot be examined
+	if args.format != 'json':
+		out.write(message)
+		return
+	if args.summary:
+		args.summary.fail()
+	print_json(dict(type='error', path=project.path, message=message.rstrip()), out)
+
+
+def finish(args, out=sys.stdout):
+	if args.summary:
+		print_json(args.summary.record(), out)
+
+
+def main():
+	lib.Lib.check()
+	args = parse_args()
+	code = run(Project.fromEnv(), args)
+	finish(args)
+	sys.exit(code)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import lib
-lib.Lib.check()
 
 import sys
 import os.path
@@ -10,102 +9,154 @@ import subprocess
 
 from git import Git
 from repostat import Stat
+from manifest import Project
 import colorize
 
 
-parser = argparse.ArgumentParser()
-action_group = parser.add_mutually_exclusive_group()
-action_group.add_argument('--abort', required=False)
-action_group.add_argument('--prepare', required=False)
-action_group.add_argument('--complete', required=False)
-action_group.add_argument('--upload', required=False)
-args = parser.parse_args()
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	action_group = parser.add_mutually_exclusive_group()
+	action_group.add_argument('--abort', required=False)
+	action_group.add_argument('--prepare', required=False)
+	action_group.add_argument('--complete', required=False)
+	action_group.add_argument('--upload', required=False)
+	return parser.parse_args(argv)
 
 
-s = Stat()
+def run(project, args, out=sys.stdout, err=sys.stderr):
+	s = Stat(project=project)
 
-print(colorize.c(s.path, bright=True))
+	print(colorize.c(s.path, bright=True), file=out)
 
-branch = args.abort or args.prepare or args.upload or args.complete
-kPrepareRevision = 'refs/prepare/' + branch
+	branch = args.abort or args.prepare or args.upload or args.complete
+	kPrepareRevision = 'refs/prepare/' + branch
 
 
-def create_prepare_branch(rev):
-	oldrev = s.git.headRev()
+	def create_prepare_branch(rev):
+		oldrev = s.git.headRev()
 
-	print('Creating prepare branch...')
-	s.git.run(['branch', kPrepareRevision, rev])
-	s.git.run(['config', 'branch.' + kPrepareRevision + '.oldrev', oldrev])
+		print('Creating prepare branch...', file=out)
+		s.git.run(['branch', kPrepareRevision, rev])
+		s.git.run(['config', 'branch.' + kPrepareRevision + '.oldrev', oldrev])
 
 
-def do_checkout_old():
-	oldrev = s.git.run(['config', 'branch.' + kPrepareRevision + '.oldrev']).stdout.strip()
-	print(f'Switching to old rev: {oldrev}')
-	s.git.run(['checkout', Git.branchForName(oldrev)])
+	def do_checkout_old():
+		oldrev = s.git.run(['config', 'branch.' + kPrepareRevision + '.oldrev']).stdout.strip()
+		print(f'Switching to old rev: {oldrev}', file=out)
+		s.git.run(['checkout', Git.branchForName(oldrev)])
 
 
-def checkout_old(force):
-	if not s.git.exists(kPrepareRevision):
-		print('Prepare branch does not exist')
-		return
+	def checkout_old(force):
+		if not s.git.exists(kPrepareRevision):
+			print('Prepare branch does not exist', file=out)
+			return 0
 
-	if force:
-		do_checkout_old()
-		return
+		if force:
+			do_checkout_old()
+			return 0
 
-	if s.git.headRev() != kPrepareRevision:
-		print(colorize.c('Prepare branch exists but not current', color=colorize.RED), file=sys.stderr)
-		exit(1)
+		if s.git.headRev() != kPrepareRevision:
+			print(colorize.c('Prepare branch exists but not current', color=colorize.RED), file=err)
+			return 1
 
+		return 0
 
-def delete_prepare_branch():
-	if s.git.exists(kPrepareRevision):
-		s.git.run(['branch', '-D', kPrepareRevision])
 
+	def delete_prepare_branch():
+		if s.git.exists(kPrepareRevision):
+			s.git.run(['branch', '-D', kPrepareRevision])
 
-if args.prepare:
-	if os.path.isdir(os.path.join(s.git.dir, 'rebase-merge')):
-		print(colorize.c('Git project is in the middle of something, aborting', color=colorize.RED), file=sys.stderr)
-		sys.exit(1)
 
-	if s.git.exists(kPrepareRevision):
-		if s.git.isFf(kPrepareRevision, s.remote_revision):
-			print('Already prepared')
-			sys.exit(0)
+	def rebase_in_object_database(onto, rev):
+		# replays onto..rev on top of onto like rebase does, dropping merges and
+		# commits already upstream, without checking anything out;
+		# returns None when a commit does not apply cleanly
+		log = s.git.run(['log', '-z', '--reverse', '--topo-order', '--cherry-pick', '--right-only', '--no-merges',
+				'--date=raw', '--format=%H%x01%P%x01%an%x01%ae%x01%ad%x01%B', f'{onto}...{rev}']).stdout
 
-		print(colorize.c('Prepared branch outdated', color=colorize.RED), file=sys.stderr)
-		sys.exit(1)
+		head = onto
+		for record in filter(None, log.split('\0')):
+			commit, parent, name, email, date, message = record.split('\x01', 5)
 
-	target_rev = s.git.optional_remote_revision(s.remote, branch)
-	target_rev_exists = s.git.exists(target_rev)
+			if parent == head:
+				# base did not change, keep the original commit
+				head = commit
+				continue
 
-	if target_rev_exists:
-		if s.git.isFf(target_rev, s.remote_revision):
-			print('Already up-to-date')
-			sys.exit(0)
+			tree = s.git.mergeTree(parent, head, commit)
+			if tree is None:
+				return None
 
-	create_prepare_branch(target_rev)
+			env = dict(os.environ, GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email, GIT_AUTHOR_DATE=date)
+			head = s.git.run(['commit-tree', tree, '-p', head, '-m', message.strip()], env=env).stdout.strip()
 
-	print('Prepared branch diverged, rebasing...')
-	s.git.run(['rebase', '--onto', s.remote_revision, s.remote_revision, kPrepareRevision])
+		return head
 
 
-if args.complete:
-	checkout_old(True)
-	delete_prepare_branch()
+	if args.prepare:
+		if os.path.isdir(os.path.join(s.git.dir, 'rebase-merge')):
+			print(colorize.c('Git project is in the middle of something, aborting', color=colorize.RED), file=err)
+			return 1
 
+		if s.remote_revision is None:
+			print(colorize.c(f'Missing manifest revision: remote: {s.remote} revision: {s.rrev}, skipping',
+					color=colorize.RED), file=out)
+			return 0
 
-if args.upload:
-	if not s.git.exists(kPrepareRevision):
-		print('No prepare branch, skipping')
-	else:
-		print('Pushing prepare branch...')
-		s.git.run(['push', '-f', s.remote, kPrepareRevision + ':' + branch])
+		refs = s.git.refs()
+		remote_id = refs.commitId(s.remote_revision)
 
+		prepare_id = refs.resolve(kPrepareRevision)
+		if prepare_id:
+			if prepare_id == remote_id or s.git.isAncestor(remote_id, prepare_id):
+				print('Already prepared', file=out)
+				return 0
 
-if args.abort:
-	checkout_old(True)
-	delete_prepare_branch()
+			print(colorize.c('Prepared branch outdated', color=colorize.RED), file=err)
+			return 1
 
+		target_rev = s.git.optional_remote_revision(s.remote, branch)
+		target_id = refs.resolve(target_rev)
 
-print()
+		prepared_id = None
+		if target_id:
+			if target_id == remote_id or s.git.isAncestor(remote_id, target_id):
+				print('Already up-to-date', file=out)
+				return 0
+
+			print('Prepared branch diverged, rebasing...', file=out)
+			prepared_id = rebase_in_object_database(remote_id, target_id)
+
+		if prepared_id:
+			create_prepare_branch(prepared_id)
+		else:
+			if target_id:
+				print('Conflicts found, rebasing in the work tree...', file=out)
+			create_prepare_branch(target_rev)
+			s.git.run(['rebase', '--onto', s.remote_revision, s.remote_revision, kPrepareRevision])
+
+
+	if args.complete:
+		checkout_old(True)
+		delete_prepare_branch()
+
+
+	if args.upload:
+		if not s.git.exists(kPrepareRevision):
+			print('No prepare branch, skipping', file=out)
+		else:
+			print('Pushing prepare branch...', file=out)
+			s.git.run(['push', '-f', s.remote, kPrepareRevision + ':' + branch])
+
+
+	if args.abort:
+		checkout_old(True)
+		delete_prepare_branch()
+
+
+	print(file=out)
+
+
+if __name__ == '__main__':
+	lib.Lib.check()
+	sys.exit(run(Project.fromEnv(), parse_args()))
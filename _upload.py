@@ -1,56 +1,111 @@
 #!/usr/bin/env python3
 
+import lib
+
 import os
 import sys
 import argparse
 from git import Git
 import colorize
 from repostat import Stat
+from manifest import Project
 
-depo_cwd = os.environ.get('DEPO_CWD')
-if depo_cwd and depo_cwd != os.getcwd():
-	sys.exit()
 
 def unhacked_head(s):
-	head = s.git.run(['rev-parse', 'HEAD']).stdout.strip()
-	if not s.filtered_revs:
+	# one walk over the local commits, each line is a commit followed by its parents
+	lines = s.git.run(['rev-list', '--parents', s.remote_revision + '..HEAD']).stdout.splitlines()
+	if not lines:
+		raise RuntimeError('No commits to push')
+
+	parents = dict()
+	for line in lines:
+		commit, *commitParents = line.split()
+		parents[commit] = commitParents
+
+	head = lines[0].split(maxsplit=1)[0]
+	hacked = set(s.filtered_revs or [])
+	if not hacked:
 		return head
-	if not head in s.filtered_revs:
+	if not head in hacked:
 		raise RuntimeError('Found hacked commits below HEAD')
-	heads = set()
-	for rev in s.filtered_revs:
-		for parent in s.git.run(['show', '--format=%P', '-s']).stdout.splitlines():
-			if not parent in s.filtered_revs:
-				heads.add(parent)
+
+	heads = {parent for rev in hacked if rev in parents for parent in parents[rev] if not parent in hacked}
+
+	# hacked commits have to stay on top of the stack
+	stack = list(heads)
+	seen = set(stack)
+	while stack:
+		for parent in parents.get(stack.pop(), ()):
+			if parent in hacked:
+				raise RuntimeError('Found hacked commits below HEAD')
+			if parent in parents and not parent in seen:
+				seen.add(parent)
+				stack.append(parent)
+
 	if not heads:
 		raise RuntimeError('No head found under hacked commits')
 	if len(heads) != 1:
 		raise RuntimeError('Too many heads found under hacked commits: ' + str(heads))
-	return list(heads)[0]
+	return heads.pop()
+
+
+def update_tracking_ref(s, rev, fetch):
+	# the pushed branch is known to point to rev now, move its remote-tracking
+	# ref locally instead of fetching the whole remote
+	if not s.remote_local_revision.startswith(Git.kRefsHeads):
+		return
+	tracking_ref = f'refs/remotes/{s.remote}/{s.remote_local_revision[len(Git.kRefsHeads):]}'
+	if fetch:
+		s.git.run(['fetch', s.remote, f'+{s.remote_local_revision}:{tracking_ref}'])
+	else:
+		s.git.run(['update-ref', '-m', 'depo: upload', tracking_ref, rev])
+
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--dry-run', dest='dry_run', action='store_true')
+	parser.add_argument('--fetch', action='store_true',
+			help='fetch the pushed branch back instead of updating its tracking ref locally')
+	return parser.parse_args(argv)
+
+
+def run(project, args, out=sys.stdout, err=sys.stderr):
+	s = Stat(project=project)
+
+	if s.no_remote_revision:
+		print(colorize.c(s.path, bright=True) + ': ' + colorize.c(f'Missing manifest revision: {s.rrev}, skipping',
+				color=colorize.RED, bright=True), file=out)
+		return
+
+	number_of_commits = len(s.commits) - len(s.filtered_revs)
+
+	if number_of_commits == 0:
+		return
+
+	print(colorize.c(s.path, bright=True) + ': ', end='', file=out)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--dry-run', dest='dry_run', action='store_true')
-args = parser.parse_args()
+	try:
+		rev_to_push = unhacked_head(s)
+	except RuntimeError as e:
+		print(colorize.c(str(e), color=colorize.RED, bright=True), file=out)
+		return
 
-s = Stat()
+	commits_message = str(number_of_commits) + ' commit' + ('s' if number_of_commits > 1 else '')
+	if args.dry_run:
+		print('Would push ' + commits_message, file=out)
+	else:
+		s.git.run(['push', s.remote, rev_to_push + ':' + s.remote_local_revision])
+		update_tracking_ref(s, rev_to_push, args.fetch)
+		print(colorize.c('Pushed ' + commits_message, color=colorize.GREEN, bright=True), file=out)
 
-number_of_commits = len(s.commits) - len(s.filtered_revs)
 
-if number_of_commits == 0:
-	sys.exit()
+def main():
+	depo_cwd = os.environ.get(lib.kCwdEnvVar)
+	if depo_cwd and depo_cwd != os.getcwd():
+		sys.exit()
 
-print(colorize.c(s.path, bright=True) + ': ', end='')
+	sys.exit(run(Project.fromEnv(), parse_args()))
 
-try:
-	rev_to_push = unhacked_head(s)
-except RuntimeError as e:
-	print(colorize.c(str(e), color=colorize.RED, bright=True))
-	sys.exit(0)
 
-commits_message = str(number_of_commits) + ' commit' + ('s' if number_of_commits > 1 else '')
-if args.dry_run:
-	print('Would push ' + commits_message)
-else:
-	s.git.run(['push', s.remote, rev_to_push + ':' + s.remote_local_revision])
-	s.git.run(['fetch', s.remote])
-	print(colorize.c('Pushed ' + commits_message, color=colorize.GREEN, bright=True))
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import subprocess
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, scripts_dir)
+
+from git import Git
+from p4 import Tree
+from workspace import make_workspace, Mix
+
+
+kP4Factor = 100
+kChangeFactor = 100
+
+
+def measure(repeat, func):
+	# a failing command is timed and reported like any other run, the exit
+	# codes are kept so such results are not mistaken for clean ones
+	runs = []
+	returncodes = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		returncodes.append(func() or 0)
+		runs.append(time.perf_counter() - start)
+	return dict(best=min(runs), median=statistics.median(runs), runs=runs, returncodes=returncodes)
+
+
+def command(args, cwd, stdin=None):
+	# depo reads its project filter from the environment, never inherit it
+	env = {k: v for k, v in os.environ.items() if not k.startswith('DEPO_')}
+
+	def run():
+		input = None
+		if stdin:
+			with open(stdin) as f:
+				input = f.read()
+		return subprocess.run(args, cwd=cwd, env=env, input=input, universal_newlines=True,
+				stdout=subprocess.DEVNULL).returncode
+	return run
+
+
+def benchmarks(root):
+	depo = [sys.executable, os.path.join(scripts_dir, 'depo')]
+	config = os.path.join(root, '.repo', 'manifests', 'config.json')
+
+	def tree_load():
+		with open(config) as f:
+			Tree.load(json.load(f))
+
+	return [
+		('status', command(depo + ['status'], root)),
+		('upload --dry-run', command(depo + ['upload', '--dry-run'], root)),
+		('sandbox push --dry-run', command(depo + ['sandbox', 'push', '--dry-run', 'bench'], root)),
+		('Tree.load', tree_load),
+		('sort-gerrit', command([sys.executable, os.path.join(scripts_dir, 'sort-gerrit.py')], root,
+				stdin=os.path.join(root, 'gerrit-refs.txt'))),
+		('sort-gerrit --latest', command([sys.executable, os.path.join(scripts_dir, 'sort-gerrit.py'), '--latest'], root,
+				stdin=os.path.join(root, 'gerrit-refs.txt'))),
+	]
+
+
+def compare(results, baseline):
+	# ratio of best times against an earlier result file, above 1 is slower
+	before = {(r['scale'], r['name']): r['best'] for r in baseline['results']}
+	for r in results['results']:
+		old = before.get((r['scale'], r['name']))
+		if old:
+			print(f'{r["scale"]:6d}  {r["name"]:24s}  {old:8.3f}s -> {r["best"]:8.3f}s  x{r["best"] / old:.2f}')
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--work', help='directory for generated workspaces, kept and reused when given')
+	parser.add_argument('--output', default='bench-results.json')
+	parser.add_argument('--compare', help='earlier result file to compare with')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('scales', nargs='*', type=int, default=[10, 100, 1000])
+	args = parser.parse_args()
+
+	work = args.work or tempfile.mkdtemp(prefix='depo-bench-')
+
+	results = dict(
+		revision=Git(scripts_dir).run(['rev-parse', 'HEAD'], check=False).stdout.strip(),
+		time=datetime.datetime.now().isoformat(timespec='seconds'),
+		python=platform.python_version(),
+		git=Git().run(['version']).stdout.strip(),
+		results=[])
+
+	try:
+		for scale in args.scales:
+			root = os.path.join(work, f'ws-{scale}')
+			if not os.path.isdir(root):
+				print(f'Generating workspace with {scale} projects...', file=sys.stderr)
+				make_workspace(root, scale, scale * kP4Factor, scale * kChangeFactor, Mix(), args.seed)
+
+			for name, func in benchmarks(root):
+				r = measure(args.repeat, func)
+				failed = f'  exit={max(r["returncodes"])}' if any(r['returncodes']) else ''
+				print(f'{scale:6d}  {name:24s}  best={r["best"]:.3f}s median={r["median"]:.3f}s{failed}', file=sys.stderr)
+				results['results'].append(dict(scale=scale, name=name, **r))
+	finally:
+		if not args.work:
+			shutil.rmtree(work)
+
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=2)
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os.path
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from p4 import Tree
+
+
+def make_config(count, fanout, depth):
+	# nested trees with `fanout` subtrees per level, projects spread over the leaves
+	leaves = fanout ** depth
+	per_leaf = max(1, (count + leaves - 1) // leaves)
+	remaining = count
+
+	def make_tree(level):
+		nonlocal remaining
+		tree = dict()
+		if level == depth:
+			n = min(per_leaf, remaining)
+			remaining -= n
+			tree['projects'] = [f'p{i}|s={i % 3}' for i in range(n)]
+			return tree
+		names = [f't{i}' for i in range(fanout)]
+		tree['trees'] = names
+		for name in names:
+			tree['tree-' + name] = make_tree(level + 1)
+		return tree
+
+	config = make_tree(0)
+	config['path'] = '//depot'
+	return config
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--fanout', type=int, default=10)
+	parser.add_argument('--depth', type=int, default=3)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('counts', nargs='*', type=int, default=[10000, 100000])
+	args = parser.parse_args()
+
+	for count in args.counts:
+		text = json.dumps(make_config(count, args.fanout, args.depth))
+
+		best = None
+		for _ in range(args.repeat):
+			start = time.perf_counter()
+			projectForName = Tree.load(json.loads(text))
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+
+		print(f'projects={len(projectForName)} load={best * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import json
+import random
+import shutil
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from git import Git
+from tree_load import make_config
+
+
+kRemote = 'origin'
+kRevision = 'master'
+kGroupSize = 100
+
+kGitEnv = dict(GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+		GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com')
+
+
+class Mix:
+	# fractions of projects getting each kind of local state
+	def __init__(self, ahead=0.3, dnm=0.1, dirty=0.2, missing=0.02):
+		self.ahead = ahead
+		self.dnm = dnm
+		self.dirty = dirty
+		self.missing = missing
+
+
+def project_path(index):
+	return f'g{index // kGroupSize:03d}/p{index:05d}'
+
+
+def make_template(dir, env):
+	# one remote and one checkout, copied for every project instead of
+	# spawning git for each of them
+	bare = os.path.join(dir, 'template.git')
+	checkout = os.path.join(dir, 'template')
+
+	Git().run(['init', '-q', '--bare', '-b', kRevision, bare])
+	Git().run(['clone', '-q', bare, checkout], check=False)
+
+	git = Git(checkout)
+	for i in range(10):
+		with open(os.path.join(checkout, f'file{i}.txt'), 'w') as f:
+			f.write(f'line {i}\n' * 100)
+	git.run(['add', '-A'])
+	git.run(['commit', '-q', '-m', 'Initial commit'], env=env)
+	git.run(['push', '-q', kRemote, 'HEAD:refs/heads/' + kRevision])
+	git.run(['fetch', '-q', kRemote])
+	git.run(['branch', '-q', '--set-upstream-to', f'{kRemote}/{kRevision}'])
+
+	return bare, checkout
+
+
+def make_project(root, path, template, rng, mix, env):
+	bare, checkout = template
+	remote = os.path.join(root, 'remotes', path + '.git')
+	dir = os.path.join(root, path)
+
+	shutil.copytree(bare, remote, symlinks=True)
+	shutil.copytree(checkout, dir, symlinks=True)
+
+	configPath = os.path.join(dir, '.git', 'config')
+	with open(configPath) as f:
+		config = f.read()
+	with open(configPath, 'w') as f:
+		f.write(config.replace(bare, remote))
+
+	git = Git(dir)
+
+	if rng.random() < mix.ahead:
+		git.run(['checkout', '-q', '-b', 'dev', '--track', f'{kRemote}/{kRevision}'])
+		for i in range(rng.randint(1, 5)):
+			git.run(['commit', '-q', '--allow-empty', '-m', f'Local change {i}'], env=env)
+		if rng.random() < mix.dnm / mix.ahead:
+			git.run(['commit', '-q', '--allow-empty', '-m', 'DO NOT MERGE: local hack'], env=env)
+
+	if rng.random() < mix.dirty:
+		with open(os.path.join(dir, 'file0.txt'), 'a') as f:
+			f.write('dirty\n')
+		with open(os.path.join(dir, 'untracked.txt'), 'w') as f:
+			f.write('untracked\n')
+
+	return None if rng.random() >= mix.missing else 'refs/heads/missing'
+
+
+def make_gerrit_refs(path, changes, rng):
+	# ls-remote style listing of review refs, unsorted like gerrit returns them
+	lines = [f'{rng.getrandbits(160):040x}\tHEAD', f'{rng.getrandbits(160):040x}\trefs/heads/master']
+	for change in range(1, changes + 1):
+		for ps in range(1, rng.randint(1, 5) + 1):
+			lines.append(f'{rng.getrandbits(160):040x}\trefs/changes/{change % 100:02d}/{change}/{ps}')
+	rng.shuffle(lines)
+	with open(path, 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+
+
+def make_workspace(root, projects, p4Projects=0, changes=0, mix=Mix(), seed=0):
+	rng = random.Random(seed)
+	env = dict(os.environ, **kGitEnv)
+
+	root = os.path.realpath(root)
+	repoDir = os.path.join(root, '.repo')
+	manifestsDir = os.path.join(repoDir, 'manifests')
+	templateDir = os.path.join(repoDir, 'bench')
+	os.makedirs(manifestsDir)
+	os.makedirs(templateDir)
+
+	template = make_template(templateDir, env)
+
+	lines = ['<manifest>',
+			f'  <remote name="{kRemote}" fetch="{os.path.join(root, "remotes")}"/>',
+			f'  <default remote="{kRemote}" revision="{kRevision}"/>']
+	for i in range(projects):
+		path = project_path(i)
+		revision = make_project(root, path, template, rng, mix, env)
+		lines.append(f'  <project name="{path}"' + (f' revision="{revision}"' if revision else '') + '/>')
+	lines.append('</manifest>')
+
+	with open(os.path.join(manifestsDir, 'default.xml'), 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	with open(os.path.join(repoDir, 'manifest.xml'), 'w') as f:
+		f.write('<manifest><include name="default.xml"/></manifest>\n')
+
+	if p4Projects:
+		with open(os.path.join(manifestsDir, 'config.json'), 'w') as f:
+			json.dump(make_config(p4Projects, 10, 3), f)
+
+	if changes:
+		make_gerrit_refs(os.path.join(root, 'gerrit-refs.txt'), changes, rng)
+
+	return root
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--projects', type=int, default=100)
+	parser.add_argument('--p4-projects', dest='p4_projects', type=int, default=10000)
+	parser.add_argument('--changes', type=int, default=10000)
+	parser.add_argument('--ahead', type=float, default=Mix().ahead)
+	parser.add_argument('--dnm', type=float, default=Mix().dnm)
+	parser.add_argument('--dirty', type=float, default=Mix().dirty)
+	parser.add_argument('--missing', type=float, default=Mix().missing)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('dir')
+	args = parser.parse_args()
+
+	make_workspace(args.dir, args.projects, args.p4_projects, args.changes,
+			Mix(args.ahead, args.dnm, args.dirty, args.missing), args.seed)
+
+
+if __name__ == '__main__':
+	main()
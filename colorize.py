@@ -1,3 +1,6 @@
+import os
+import sys
+
 
 BLACK   = 0
 RED     = 1
@@ -10,17 +13,40 @@ WHITE   = 7
 
 TOKEN = '\033['
 
+# forces color on (1) or off (0), inherited by child processes
+kColorEnvVar = 'DEPO_COLOR'
+
+
+def detect():
+	value = os.environ.get(kColorEnvVar)
+	if value:
+		return value.lower() not in ('0', 'never', 'no', 'false')
+	return sys.stdout.isatty()
+
+enabled = detect()
+
+def escapes(color, bright, dark):
+	return (TOKEN
+			+ ('' if dark else ';')
+			+ ('' if color == None else str(30 + color))
+			+ (';1' if bright else '')
+			+ 'm',
+		TOKEN
+			+ ('' if dark else '0')
+			+ 'm')
+
+# prefix and suffix for the common styles, built once instead of for every string
+ESCAPES = {(color, bright, dark): escapes(color, bright, dark)
+	for color in (None, BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE)
+	for bright in (False, True)
+	for dark in (False, True)}
+
 def c(text, color=None, bright=False, dark=False):
-	return '' \
-		+ TOKEN \
-		+ ('' if dark else ';') \
-		+ ('' if color == None else str(30 + color)) \
-		+ (';1' if bright else '') \
-		+ 'm' \
-		+ text \
-		+ TOKEN \
-		+ ('' if dark else '0') \
-		+ 'm'
+	if not enabled:
+		return text
+	key = (color, bright, dark)
+	prefix, suffix = ESCAPES[key] if key in ESCAPES else escapes(color, bright, dark)
+	return prefix + text + suffix
 
 def u(text):
 	if text.startswith(TOKEN):
@@ -2,8 +2,26 @@
 
 
 import argparse
+import json
+import os
 import os.path
 import subprocess
+import sys
+import time
+
+
+def wait(process):
+	# returns (returncode, cpu seconds, peak rss in KiB), usage is only
+	# available where os.wait4 exists
+	if not hasattr(os, 'wait4'):
+		return process.wait(), None, None
+
+	_, status, usage = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(status)
+
+	# ru_maxrss is in bytes on macOS and in KiB elsewhere
+	maxrss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+	return process.returncode, usage.ru_utime + usage.ru_stime, maxrss
 
 
 def main():
@@ -16,21 +34,29 @@ def main():
 
 	os.makedirs(output_dir, exist_ok=True)
 
-	path = os.environ['REPO_PATH'].replace('/', '__')
+	repo_path = os.environ['REPO_PATH']
+	path = repo_path.replace('/', '__')
 
-	r = subprocess.run(cli, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stdout_file = f'{output_dir}/{path}_stdout.log'
+	stderr_file = f'{output_dir}/{path}_stderr.log'
 
-	if r.returncode != 0:
-		with open(f'{output_dir}/{path}.returncode_{r.returncode}.log', 'w') as f:
-			pass
+	# output goes to the log files while the project runs, never held in memory
+	start = time.perf_counter()
+	with open(stdout_file, 'wb') as stdout, open(stderr_file, 'wb') as stderr:
+		process = subprocess.Popen(cli, stdout=stdout, stderr=stderr)
+		returncode, cpu, maxrss = wait(process)
+	wall = time.perf_counter() - start
+
+	for file in (stdout_file, stderr_file):
+		if os.path.getsize(file) == 0:
+			os.remove(file)
 
-	if len(r.stdout) != 0:
-		with open(f'{output_dir}/{path}_stdout.log', 'w') as f:
-			f.write(r.stdout)
+	if returncode != 0:
+		with open(f'{output_dir}/{path}.returncode_{returncode}.log', 'w') as f:
+			pass
 
-	if len(r.stderr) != 0:
-		with open(f'{output_dir}/{path}_stderr.log', 'w') as f:
-			f.write(r.stderr)
+	with open(f'{output_dir}/{path}.stats.json', 'w') as f:
+		json.dump({'path': repo_path, 'returncode': returncode, 'wall': wall, 'cpu': cpu, 'maxrss': maxrss}, f)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+import io
+import sys
+import subprocess
+import traceback
+import concurrent.futures
+
+
+class Result:
+	def __init__(self, project):
+		self.project = project
+		self.output = io.StringIO()
+		self.returncode = 0
+
+
+class Executor:
+	def __init__(self, jobs, ordered=True):
+		self.jobs = max(1, jobs)
+		self.ordered = ordered
+
+	def __runProject(self, module, project, args):
+		result = Result(project)
+		message = io.StringIO()
+
+		try:
+			result.returncode = module.run(project, args, result.output, result.output) or 0
+		except subprocess.CalledProcessError as e:
+			stderr = e.stderr.decode(errors='replace') if type(e.stderr) == bytes else e.stderr
+			print(f'{project.path}: subcommand failed (exit code: {e.returncode}):', e.cmd, file=message)
+			if stderr:
+				print(stderr.rstrip(), file=message)
+			result.returncode = e.returncode or 1
+		except Exception:
+			print(f'{project.path}: failed', file=message)
+			traceback.print_exc(file=message)
+			result.returncode = 1
+
+		if message.tell():
+			# commands with a structured output report failures their own way
+			fail = getattr(module, 'fail', None)
+			if fail:
+				fail(project, args, message.getvalue(), result.output)
+			else:
+				result.output.write(message.getvalue())
+
+		return result
+
+	def run(self, module, projects, args):
+		failed = []
+
+		pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+		try:
+			futures = [pool.submit(self.__runProject, module, project, args) for project in projects]
+
+			# whole project blocks are written, either as soon as each one is
+			# done or in manifest order as soon as all projects before it are done
+			results = (f.result() for f in concurrent.futures.as_completed(futures)) if not self.ordered \
+					else (f.result() for f in futures)
+
+			for result in results:
+				sys.stdout.write(result.output.getvalue())
+				sys.stdout.flush()
+				result.output = None
+
+				if result.returncode != 0:
+					failed.append(result)
+		except BaseException:
+			# on Ctrl-C only the projects already running are finished,
+			# nothing queued is started anymore
+			pool.shutdown(wait=False, cancel_futures=True)
+			raise
+		pool.shutdown()
+
+		# commands may print a closing record once every project is done
+		finish = getattr(module, 'finish', None)
+		if finish:
+			finish(args, sys.stdout)
+			sys.stdout.flush()
+
+		return failed
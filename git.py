@@ -1,27 +1,497 @@
 
+import os
+import os.path
+import re
 import subprocess
+import tempfile
+import threading
+import weakref
+
+import tracing
+
+
+class BatchCheck:
+	def __init__(self, args):
+		self.process = subprocess.Popen(args + ['cat-file', '--batch-check'],
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				stderr=subprocess.DEVNULL, universal_newlines=True)
+		self.lock = threading.Lock()
+		self.finalizer = weakref.finalize(self, BatchCheck.__close, self.process)
+
+	def __close(process):
+		try:
+			process.stdin.close()
+		except OSError:
+			pass
+		process.wait()
+
+	def close(self):
+		self.finalizer()
+
+	def lookup(self, rev):
+		with self.lock:
+			self.process.stdin.write(rev + '\n')
+			self.process.stdin.flush()
+			line = self.process.stdout.readline()
+
+		if not line:
+			raise BrokenPipeError('git cat-file exited')
+
+		# either "<sha> <type> <size>" or "<rev> missing|ambiguous"
+		tokens = line.split()
+		if len(tokens) != 3 or tokens[-1] in ('missing', 'ambiguous'):
+			return None
+		return tokens[0]
+
+
+class Refs:
+	kPlainNameRe = re.compile(r'^[A-Za-z0-9._/+-]+$')
+	kHexRe = re.compile(r'^[0-9a-fA-F]{4,40}$')
+	kPseudoRefRe = re.compile(r'^[A-Z_]+$')
+
+	def __init__(self, git, refs, config, head=False):
+		self.git = git
+		self.refs = refs
+		self.configs = config
+		self.head = head if head is not False else None
+		self.hasHead = head is not False
+
+	def load(git):
+		refs = dict()
+		for line in git.run(['for-each-ref', '--format=%(objectname) %(refname)']).stdout.splitlines():
+			commit_id, name = line.split(' ', 1)
+			refs[name] = commit_id
+
+		config = dict()
+		for entry in git.run(['config', '-z', '--get-regexp', r'^branch\.'], check=False).stdout.split('\0'):
+			if entry:
+				key, _, value = entry.partition('\n')
+				config[key] = value
+
+		return Refs(git, refs, config)
+
+	def read(git):
+		gitDir = git.gitDir()
+		if gitDir is None:
+			return None
+
+		try:
+			return Refs(git, gitDir.refs(), gitDir.config(), gitDir.headRef())
+		except Unsupported:
+			return None
+
+	def headRef(self):
+		# symbolic name of HEAD or None when detached
+		if not self.hasHead:
+			ref = self.git.run(['symbolic-ref', '-q', 'HEAD'], check=False).stdout.strip()
+			self.head = ref if ref else None
+			self.hasHead = True
+		return self.head
+
+	def config(self, key):
+		return self.configs.get(key)
+
+	def isRefName(rev):
+		# names which can only be resolved through refs, anything else
+		# (object ids, pseudo refs, rev expressions) is asked from git
+		return Refs.kPlainNameRe.match(rev) and not Refs.kHexRe.match(rev) \
+				and not Refs.kPseudoRefRe.match(rev)
+
+	def resolve(self, rev):
+		for name in (rev, 'refs/' + rev, Git.kRefsTags + rev, Git.kRefsHeads + rev,
+				'refs/remotes/' + rev, 'refs/remotes/' + rev + '/HEAD'):
+			commit_id = self.refs.get(name)
+			if commit_id:
+				return commit_id
+
+	def exists(self, rev):
+		if Refs.isRefName(rev):
+			return self.resolve(rev) is not None
+		return self.git.exists(rev)
+
+	def commitId(self, rev):
+		commit_id = self.resolve(rev) if Refs.isRefName(rev) else None
+		return commit_id if commit_id else self.git.commitId(rev)
+
+	def get_commit_id_rev(self, rev):
+		# only a hex string can be a prefix of the commit id it resolves to
+		if Refs.kHexRe.match(rev):
+			return self.git.get_commit_id_rev(rev)
+
+
+class Unsupported(Exception):
+	pass
+
+
+class GitDir:
+	kPerWorktreePrefixes = ('refs/bisect/', 'refs/worktree/', 'refs/rewritten/')
+	kMaxSymrefDepth = 5
+	kObjectIdRe = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+	kConfigEscapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+	def __init__(self, gitDir, commonDir):
+		self.gitDir = gitDir
+		self.commonDir = commonDir
+		self.packed = None
+		self.packedStat = None
+		self.configs = None
+
+		if os.path.isdir(os.path.join(commonDir, 'reftable')):
+			raise Unsupported('reftable')
+
+	def find(dir):
+		dotGit = os.path.join(dir, '.git')
+
+		if os.path.isdir(dotGit):
+			gitDir = dotGit
+		elif os.path.isfile(dotGit):
+			with open(dotGit, 'r') as f:
+				line = f.readline().strip()
+			if not line.startswith('gitdir:'):
+				raise Unsupported(dotGit)
+			gitDir = os.path.join(dir, line[len('gitdir:'):].strip())
+		elif os.path.isfile(os.path.join(dir, 'HEAD')) and os.path.isdir(os.path.join(dir, 'objects')):
+			# bare repository
+			gitDir = dir
+		else:
+			raise Unsupported(dir)
+
+		commonDir = gitDir
+		commonFile = os.path.join(gitDir, 'commondir')
+		if os.path.isfile(commonFile):
+			with open(commonFile, 'r') as f:
+				commonDir = os.path.join(gitDir, f.read().strip())
+
+		return GitDir(os.path.normpath(gitDir), os.path.normpath(commonDir))
+
+	def __refPath(self, name):
+		if name.startswith('/') or '..' in name or '\\' in name:
+			raise Unsupported(name)
+		isCommon = name.startswith('refs/') and not name.startswith(GitDir.kPerWorktreePrefixes)
+		return os.path.join(self.commonDir if isCommon else self.gitDir, *name.split('/'))
+
+	def __readLoose(self, name):
+		try:
+			with open(self.__refPath(name), 'r') as f:
+				return f.readline().strip()
+		except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+			return None
+
+	def packedRefs(self):
+		file = os.path.join(self.commonDir, 'packed-refs')
+		try:
+			st = os.stat(file)
+		except FileNotFoundError:
+			self.packed = dict()
+			self.packedStat = None
+			return self.packed
+
+		stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+		if self.packed is None or self.packedStat != stat:
+			packed = dict()
+			with open(file, 'r') as f:
+				for line in f:
+					if line.startswith('#') or line.startswith('^'):
+						continue
+					tokens = line.split()
+					if len(tokens) == 2:
+						packed[tokens[1]] = tokens[0]
+			self.packed = packed
+			self.packedStat = stat
+		return self.packed
+
+	def readRef(self, name):
+		# commit id the ref points to, following symbolic refs, or None
+		for _ in range(GitDir.kMaxSymrefDepth):
+			value = self.__readLoose(name)
+			if value is None:
+				return self.packedRefs().get(name) if name.startswith('refs/') else None
+			if value.startswith('ref:'):
+				name = value[len('ref:'):].strip()
+				continue
+			if not GitDir.kObjectIdRe.match(value.split()[0] if value else ''):
+				raise Unsupported(name)
+			return value.split()[0]
+		raise Unsupported(name)
+
+	def headRef(self):
+		value = self.__readLoose('HEAD')
+		if value is None:
+			raise Unsupported('HEAD')
+		return value[len('ref:'):].strip() if value.startswith('ref:') else None
+
+	def symbolicRef(self, name):
+		# target of a loose symbolic ref, None when missing or not symbolic
+		value = self.__readLoose(name)
+		return value[len('ref:'):].strip() if value and value.startswith('ref:') else None
+
+	def lookup(self, rev):
+		# same dwim order as git rev-parse, None when nothing matches
+		if Refs.kPseudoRefRe.match(rev):
+			commit_id = self.readRef(rev)
+			if commit_id is not None:
+				return commit_id
+		elif not Refs.isRefName(rev):
+			raise Unsupported(rev)
+
+		for name in ('refs/' + rev, Git.kRefsTags + rev, Git.kRefsHeads + rev,
+				'refs/remotes/' + rev, 'refs/remotes/' + rev + '/HEAD'):
+			commit_id = self.readRef(name)
+			if commit_id is not None:
+				return commit_id
+
+		return self.readRef(rev) if rev.startswith('refs/') else None
+
+	def refs(self):
+		refs = dict()
+
+		names = set(self.packedRefs().keys())
+		for root in set((self.commonDir, self.gitDir)):
+			refsDir = os.path.join(root, 'refs')
+			for dirpath, dirnames, filenames in os.walk(refsDir):
+				for filename in filenames:
+					names.add('/'.join(['refs'] + os.path.relpath(os.path.join(dirpath, filename), refsDir).split(os.sep)))
+
+		for name in names:
+			commit_id = self.readRef(name)
+			if commit_id is not None:
+				refs[name] = commit_id
+
+		return refs
+
+	def config(self):
+		if self.configs is None:
+			configs = dict()
+			GitDir.__parseConfig(os.path.join(self.commonDir, 'config'), configs)
+
+			if configs.get('extensions.refstorage', 'files') != 'files':
+				raise Unsupported('extensions.refstorage')
+			if configs.get('extensions.worktreeconfig', 'false').lower() in ('true', 'yes', 'on', '1'):
+				GitDir.__parseConfig(os.path.join(self.gitDir, 'config.worktree'), configs)
+
+			self.configs = configs
+		return self.configs
+
+	def __parseConfig(file, configs):
+		try:
+			with open(file, 'r') as f:
+				text = f.read()
+		except FileNotFoundError:
+			return
+
+		section = None
+		i = 0
+		n = len(text)
+
+		def skipLine(i):
+			end = text.find('\n', i)
+			return n if end == -1 else end + 1
+
+		while i < n:
+			c = text[i]
+			if c in ' \t\r\n':
+				i += 1
+			elif c in '#;':
+				i = skipLine(i)
+			elif c == '[':
+				end = text.find(']', i)
+				if end == -1:
+					raise Unsupported(file)
+				header = text[i+1:end].strip()
+				quote = header.find('"')
+				if quote != -1:
+					if not header.endswith('"'):
+						raise Unsupported(file)
+					name = header[:quote].strip().lower()
+					subsection = header[quote+1:-1].replace('\\"', '"').replace('\\\\', '\\')
+					section = name + '.' + subsection
+				elif '.' in header:
+					name, subsection = header.split('.', 1)
+					section = name.lower() + '.' + subsection.lower()
+				else:
+					section = header.lower()
+				if section.split('.', 1)[0] in ('include', 'includeif'):
+					# included files may define anything, let git resolve them
+					raise Unsupported(file)
+				i = end + 1
+			else:
+				if section is None:
+					raise Unsupported(file)
+
+				start = i
+				while i < n and (text[i].isalnum() or text[i] == '-'):
+					i += 1
+				key = section + '.' + text[start:i].lower()
+
+				while i < n and text[i] in ' \t':
+					i += 1
+
+				if i >= n or text[i] in '\r\n#;':
+					# a variable without value, reported as empty like git config does
+					configs[key] = ''
+					i = skipLine(i) if i < n and text[i] in '#;' else i
+					continue
+
+				if text[i] != '=':
+					raise Unsupported(file)
+				i += 1
+
+				value, i = GitDir.__parseValue(text, i, file)
+				configs[key] = value
+
+	def __parseValue(text, i, file):
+		n = len(text)
+		value = ''
+		pending = ''
+		quoted = False
+
+		while i < n:
+			c = text[i]
+			if c == '\n':
+				if quoted:
+					raise Unsupported(file)
+				i += 1
+				break
+			elif c in ' \t' and not quoted:
+				# whitespace is kept only between words
+				if value:
+					pending += c
+			elif c in '#;' and not quoted:
+				end = text.find('\n', i)
+				i = n if end == -1 else end + 1
+				break
+			elif c == '"':
+				value += pending
+				pending = ''
+				quoted = not quoted
+			elif c == '\\':
+				i += 1
+				if i >= n:
+					raise Unsupported(file)
+				e = text[i]
+				if e == '\n':
+					pass
+				elif e == '\r' and i + 1 < n and text[i + 1] == '\n':
+					i += 1
+				elif e in GitDir.kConfigEscapes:
+					value += pending + GitDir.kConfigEscapes[e]
+					pending = ''
+				else:
+					raise Unsupported(file)
+			elif c == '\r':
+				pass
+			else:
+				value += pending + c
+				pending = ''
+			i += 1
+
+		return value, i
+
 
 class Git:
 	kRefsHeads = 'refs/heads/'
 	kRefsTags = 'refs/tags/'
 
-	def __init__(self, dir=None):
+	__version = None
+
+	def __init__(self, dir=None, batch=False, direct=False):
 		self.dir = dir
+		self.batch = batch
+		self.batchCheck = None
+		self.direct = direct
+		self.directDir = None
 
-	def run(self, args, check=True, color=False, encode=True):
+	def run(self, args, check=True, color=False, encode=True, env=None, input=None):
 		local_args = ['-C', self.dir] if self.dir != None else []
 		color_args = ['-c', f'color.ui={"always" if color else "never"}']
 
-		return subprocess.run(['git'] + local_args + ['--no-pager']
-				+ color_args + args,
+		cmd = ['git'] + local_args + ['--no-pager'] + color_args + args
+
+		if tracing.tracer is None:
+			return subprocess.run(cmd, input=input,
+					stdout=subprocess.PIPE,
+					stderr=subprocess.PIPE, universal_newlines=encode,
+					check=check, env=env)
+
+		return tracing.tracer.run('git ' + args[0], cmd, self.dir if self.dir != None else os.getcwd(),
+				input=input,
 				stdout=subprocess.PIPE,
 				stderr=subprocess.PIPE, universal_newlines=encode,
-				check=check)
+				check=check, env=env)
+
+	def close(self):
+		if self.batchCheck:
+			self.batchCheck.close()
+			self.batchCheck = None
+
+	def gitDir(self):
+		# direct reader of the repository files, None when not enabled or not possible
+		if self.direct and self.directDir is None:
+			try:
+				self.directDir = GitDir.find(self.dir if self.dir != None else os.getcwd())
+			except (Unsupported, OSError):
+				self.direct = False
+		return self.directDir
+
+	def __readDirect(self, rev):
+		# returns (handled, commit_id)
+		gitDir = self.gitDir()
+		if gitDir is None:
+			return False, None
+		try:
+			return True, gitDir.lookup(rev)
+		except (Unsupported, OSError):
+			return False, None
+
+	def __isBatchable(rev):
+		# cat-file takes a single object name per line, anything that looks
+		# like a range, an option or has whitespace goes through rev-parse
+		return rev and not rev.startswith('-') and '..' not in rev and not any(c.isspace() for c in rev)
+
+	def __lookup(self, rev):
+		if not self.batchCheck:
+			local_args = ['-C', self.dir] if self.dir != None else []
+			self.batchCheck = BatchCheck(['git'] + local_args)
+		return self.batchCheck.lookup(rev)
 
 	def mergeBase(self, a, b):
 		return self.run(['merge-base', a, b]).stdout.strip()
 
+	def isAncestor(self, ancestor, rev):
+		return self.run(['merge-base', '--is-ancestor', ancestor, rev], check=False).returncode == 0
+
+	def mergeTree(self, base, ours, theirs):
+		# three-way merge in the object database only, returns the written
+		# tree id or None when the merge has conflicts
+		if Git.version() >= (2, 40):
+			r = self.run(['merge-tree', '--write-tree', '--merge-base=' + base, ours, theirs], check=False)
+			if r.returncode == 0:
+				return r.stdout.split(maxsplit=1)[0]
+			if r.returncode == 1:
+				return None
+			raise subprocess.CalledProcessError(r.returncode, r.args, r.stdout, r.stderr)
+
+		# older merge-tree cannot take an explicit merge base, only trivial
+		# merges are resolved there in a scratch index
+		with tempfile.TemporaryDirectory() as tmpDir:
+			env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmpDir, 'index'))
+			if self.run(['read-tree', '-i', '-m', '--aggressive', base, ours, theirs], check=False, env=env).returncode != 0:
+				return None
+			if self.run(['ls-files', '--unmerged'], env=env).stdout:
+				return None
+			return self.run(['write-tree'], env=env).stdout.strip()
+
 	def commitId(self, rev):
+		commit_id = self.__readDirect(rev)[1]
+		if commit_id:
+			return commit_id
+
+		if self.batch and Git.__isBatchable(rev):
+			commit_id = self.__lookup(rev)
+			if commit_id:
+				return commit_id
+		# let rev-parse resolve or report the error
 		return self.run(['rev-parse', rev]).stdout.strip()
 
 	def isFf(self, source, target):
@@ -29,6 +499,13 @@ class Git:
 		return base == self.commitId(target)
 
 	def exists(self, rev):
+		handled, commit_id = self.__readDirect(rev)
+		if handled:
+			return commit_id is not None
+
+		if self.batch and Git.__isBatchable(rev):
+			return self.__lookup(rev) is not None
+
 		try:
 			self.run(['rev-parse', rev])
 			return True
@@ -36,10 +513,35 @@ class Git:
 			return False
 
 	def headRev(self):
+		gitDir = self.gitDir()
+		if gitDir is not None:
+			try:
+				rev = gitDir.headRef()
+				return rev if rev else gitDir.readRef('HEAD')
+			except (Unsupported, OSError):
+				pass
+
 		rev = self.run(['rev-parse', '--symbolic-full-name', 'HEAD']).stdout.strip()
 		return rev if rev != 'HEAD' else self.run(['rev-parse', 'HEAD']).stdout.strip()
 
+	def symbolicRef(self, name):
+		gitDir = self.gitDir()
+		if gitDir is not None:
+			try:
+				return gitDir.symbolicRef(name)
+			except (Unsupported, OSError):
+				pass
+
+		r = self.run(['symbolic-ref', '-q', name], check=False)
+		return r.stdout.strip() if r.returncode == 0 else None
+
 	def get_commit_id_rev(self, rev):
+		if self.batch and Git.__isBatchable(rev):
+			commit_id = self.__lookup(rev)
+			if commit_id and commit_id.startswith(rev):
+				return commit_id
+			return None
+
 		try:
 			commit_id = self.run(['rev-parse', rev]).stdout.strip()
 			if commit_id.startswith(rev):
@@ -47,21 +549,27 @@ class Git:
 		except subprocess.CalledProcessError:
 			pass
 
-	def valid_remote_revision(self, remote, rev):
+	def refs(self):
+		refs = Refs.read(self) if self.direct else None
+		return refs if refs else Refs.load(self)
+
+	def valid_remote_revision(self, remote, rev, refs=None):
+		lookup = refs if refs else self
+
 		# if this is a commit id or short commit id then return it as is
-		commit_id = self.get_commit_id_rev(rev)
+		commit_id = lookup.get_commit_id_rev(rev)
 		if not commit_id is None:
 			return commit_id
 
 		# if this is a tag then return it as is
 		if rev.startswith(Git.kRefsTags):
 			# validate it exists
-			self.run(['rev-parse', rev])
+			lookup.commitId(rev)
 			return rev
 
 		# if this is a short tag
 		maybe_full_tag = f'{Git.kRefsTags}{rev}'
-		if self.exists(maybe_full_tag):
+		if lookup.exists(maybe_full_tag):
 			return maybe_full_tag
 
 		# if this is a full branch name
@@ -72,7 +580,7 @@ class Git:
 			short_branch_name = rev
 		remote_rev = f'{remote}/{short_branch_name}'
 		# check it exists
-		if self.exists(remote_rev):
+		if lookup.exists(remote_rev):
 			return remote_rev
 
 	def optional_remote_revision(self, remote, rev):
@@ -82,9 +590,11 @@ class Git:
 			return rev
 		return remote + '/' + rev
 
-	def remote_local_revision(self, rev):
+	def remote_local_revision(self, rev, refs=None):
+		lookup = refs if refs else self
+
 		# if this is a commit id or short commit id then return it as is
-		commit_id = self.get_commit_id_rev(rev)
+		commit_id = lookup.get_commit_id_rev(rev)
 		if not commit_id is None:
 			return commit_id
 		if rev.startswith('refs/'):
@@ -92,5 +602,10 @@ class Git:
 		else:
 			return Git.kRefsHeads + rev
 
+	def version():
+		if Git.__version is None:
+			Git.__version = tuple(int(n) for n in re.findall(r'\d+', Git().run(['version']).stdout)[:3])
+		return Git.__version
+
 	def branchForName(rev):
 		return rev.replace(Git.kRefsHeads, '') if rev.startswith(Git.kRefsHeads) else rev
@@ -5,6 +5,27 @@ import os.path
 
 kIncludeProjectsEnvVar = 'DEPO_INCLUDE_PROJECTS'
 kExcludeProjectsEnvVar = 'DEPO_EXCLUDE_PROJECTS'
+kCwdEnvVar = 'DEPO_CWD'
+
+
+class ProjectFilter:
+	def __init__(self, include=None, exclude=None):
+		self.include = None if include is None else set(include)
+		self.exclude = set(exclude) if exclude else set()
+
+	def fromEnv():
+		envIncludeProjects = os.environ.get(kIncludeProjectsEnvVar)
+		envExcludeProjects = os.environ.get(kExcludeProjectsEnvVar)
+		return ProjectFilter(None if envIncludeProjects == None else envIncludeProjects.split(':'),
+				None if envExcludeProjects == None else envExcludeProjects.split(':'))
+
+	def isActive(self):
+		return self.include is not None or bool(self.exclude)
+
+	def accepts(self, projectName):
+		if self.include is not None and not projectName in self.include:
+			return False
+		return not projectName in self.exclude
 
 
 class Lib:
@@ -32,14 +53,5 @@ class Lib:
 		Lib().__check()
 
 	def __check(self):
-		envIncludeProjects = os.environ.get(kIncludeProjectsEnvVar)
-		if envIncludeProjects != None:
-			projects = envIncludeProjects.split(':')
-			if not self.projectName in projects:
-				sys.exit()
-
-		envExcludeProjects = os.environ.get(kExcludeProjectsEnvVar)
-		if envExcludeProjects != None:
-			projects = envExcludeProjects.split(':')
-			if self.projectName in projects:
-				sys.exit()
+		if not ProjectFilter.fromEnv().accepts(self.projectName):
+			sys.exit()
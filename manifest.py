@@ -0,0 +1,101 @@
+import os
+import os.path
+import xml.etree.ElementTree as ET
+
+import lib
+
+
+class Project:
+	def __init__(self, path, remote, rrev, dir, rootDir):
+		self.path = path
+		self.remote = remote
+		self.rrev = rrev
+		self.dir = dir
+		self.rootDir = rootDir
+
+	def fromEnv():
+		return Project(os.environ['REPO_PATH'], os.environ['REPO_REMOTE'], os.environ['REPO_RREV'],
+				os.getcwd(), lib.Lib().rootDir)
+
+	def env(self):
+		return {'REPO_PATH': self.path, 'REPO_REMOTE': self.remote, 'REPO_RREV': self.rrev}
+
+
+class Manifest:
+	def __init__(self, rootDir):
+		self.rootDir = rootDir
+		self.repoDir = os.path.join(rootDir, '.repo')
+		self.manifestsDir = os.path.join(self.repoDir, 'manifests')
+
+		self.remotes = dict()
+		self.defaultRemote = None
+		self.defaultRevision = None
+		self.projectForName = dict()
+
+		self.__parse(os.path.join(self.repoDir, 'manifest.xml'))
+
+		localDir = os.path.join(self.repoDir, 'local_manifests')
+		if os.path.isdir(localDir):
+			for name in sorted(os.listdir(localDir)):
+				if name.endswith('.xml'):
+					self.__parse(os.path.join(localDir, name))
+
+	def __parse(self, file):
+		root = ET.parse(file).getroot()
+
+		for node in root:
+			if node.tag == 'include':
+				self.__parse(os.path.join(self.manifestsDir, node.get('name')))
+			elif node.tag == 'remote':
+				self.remotes[node.get('name')] = node
+			elif node.tag == 'default':
+				self.defaultRemote = node.get('remote', self.defaultRemote)
+				self.defaultRevision = node.get('revision', self.defaultRevision)
+			elif node.tag == 'project':
+				self.__addProject(node, None)
+			elif node.tag == 'extend-project':
+				project = self.projectForName.get(node.get('name'))
+				if project is not None:
+					for key in ('remote', 'revision'):
+						if node.get(key) is not None:
+							project[key] = node.get(key)
+			elif node.tag == 'remove-project':
+				self.projectForName.pop(node.get('name'), None)
+
+	def __addProject(self, node, parentPath):
+		name = node.get('name')
+		path = node.get('path', name)
+		if parentPath:
+			path = os.path.join(parentPath, path)
+
+		self.projectForName[name] = {
+			'path': os.path.normpath(path),
+			'remote': node.get('remote'),
+			'revision': node.get('revision'),
+		}
+
+		for child in node.findall('project'):
+			self.__addProject(child, path)
+
+	def projects(self):
+		projects = []
+
+		for p in self.projectForName.values():
+			remoteName = p['remote'] or self.defaultRemote
+			remote = self.remotes.get(remoteName)
+
+			if remote is not None:
+				rrev = p['revision'] or remote.get('revision') or self.defaultRevision
+				remoteName = remote.get('alias') or remoteName
+			else:
+				rrev = p['revision'] or self.defaultRevision
+
+			dir = os.path.join(self.rootDir, p['path'])
+
+			# skip projects which were never synced, as repo forall does
+			if not os.path.exists(os.path.join(dir, '.git')):
+				continue
+
+			projects.append(Project(p['path'], remoteName, rrev, dir, self.rootDir))
+
+		return sorted(projects, key=lambda p: p.path)
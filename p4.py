@@ -1,16 +1,29 @@
 #!/usr/bin/env python3
 
 import json
+import hashlib
 import os.path
 import subprocess
 import argparse
 import io
 import sys
 import enum
-import queue
+import re
+import time
+import codecs
+import collections
+import heapq
+import itertools
+import random
+import shlex
+import shutil
+import asyncio
+import tempfile
 import threading
+import concurrent.futures
 
 from git import Git
+import tracing
 
 
 kDebugTasks = True
@@ -56,7 +69,6 @@ class Project:
 
 	def remotePath(self):
 		treePath = self.tree.remotePath()
-		print(f'treePath={treePath}')
 		if self.client:
 			return treePath
 		selfPath = self.name
@@ -97,7 +109,6 @@ class Tree:
 		return os.path.normpath(os.path.join(parentPath, selfPath) if parentPath else selfPath)
 
 	def remotePath(self):
-		print(f'tree self.parent={self.parent} self.path={self.path}')
 		if self.path and self.path.startswith('//'):
 			return self.path
 		if not self.parent:
@@ -111,30 +122,351 @@ class Tree:
 		return projectForName
 
 	def __parseTrees(trees, projectForName):
-		if not trees:
-			return
+		index = PathIndex()
+
+		while trees:
+			tree = trees.pop()
+
+			for p in tree.projectForName.values():
+				path = p.localPath()
+				index.add(path)
+				projectForName[path] = p
+
+			trees.extend(tree.treeForName.values())
+
+
+class IndexedProject:
+	def __init__(self, name, local, remote, sync, binary, enabled, client):
+		self.name = name
+		self.local = local
+		self.remote = remote
+		self.sync = sync
+		self.binary = binary
+		self.enabled = enabled
+		self.client = client
+
+	def localPath(self):
+		return self.local
+
+	def remotePath(self):
+		return self.remote
+
+
+class Index:
+	# precomputed projects of a config file, kept in columns of joined
+	# strings so loading parses one small JSON document instead of the
+	# whole tree; the columns are split into per-project strings on load
+	kVersion = 1
+
+	def __init__(self, index):
+		self.settings = index['settings']
+		self.names = Index.__split(index['names'])
+		self.local = Index.__split(index['local'])
+		self.remote = Index.__split(index['remote'])
+		self.sync = index['sync']
+		self.flags = index['flags']
+		self.clients = {int(i): client for i, client in index['clients'].items()}
+		self.projectForName = None
+
+	def __split(column):
+		return column.split('\n') if column else []
+
+	def __file(configPath):
+		# stored under .repo/depo, out of the manifests checkout, when the
+		# config belongs to a repo workspace and next to it otherwise
+		path = os.path.realpath(configPath)
+		d = os.path.dirname(path)
+		while True:
+			if os.path.isdir(os.path.join(d, '.repo')):
+				name = os.path.relpath(path, d).replace(os.sep, '__')
+				return os.path.join(d, '.repo', 'depo', 'p4', name + '.index')
+			parent = os.path.dirname(d)
+			if parent == d:
+				return configPath + '.index'
+			d = parent
+
+	def __stat(configPath):
+		st = os.stat(configPath)
+		return [st.st_mtime_ns, st.st_size]
+
+	def __build(data):
+		config = json.loads(data)
+		projects = list(Tree.load(config).values())
+		return {
+			'settings': {k: v for k, v in config.items() if not isinstance(v, (dict, list))},
+			'names': '\n'.join(p.name for p in projects),
+			'local': '\n'.join(p.localPath() for p in projects),
+			'remote': '\n'.join(p.remotePath() or '' for p in projects),
+			'sync': [p.sync for p in projects],
+			'flags': ''.join(str(int(p.binary) | int(p.enabled) << 1) for p in projects),
+			'clients': {str(i): p.client for i, p in enumerate(projects) if p.client},
+		}
+
+	def __write(configPath, index):
+		file = Index.__file(configPath)
+		tmp = f'{file}.{os.getpid()}.tmp'
+		try:
+			os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+			with open(tmp, 'w') as f:
+				json.dump(index, f, separators=(',', ':'))
+			os.replace(tmp, file)
+		except OSError:
+			# the index is only an optimization, e.g. the directory may be read-only
+			if os.path.exists(tmp):
+				os.remove(tmp)
+
+	def load(configPath):
+		stat = Index.__stat(configPath)
+
+		try:
+			with open(Index.__file(configPath), 'r') as f:
+				index = json.load(f)
+			if index.get('version') != Index.kVersion:
+				index = None
+		except (OSError, ValueError):
+			index = None
+
+		if index is None or index['stat'] != stat:
+			with open(configPath, 'rb') as f:
+				data = f.read()
+			sha1 = hashlib.sha1(data).hexdigest()
+
+			if index is None or index['sha1'] != sha1:
+				index = Index.__build(data)
+				index['version'] = Index.kVersion
+				index['sha1'] = sha1
+
+			index['stat'] = stat
+			Index.__write(configPath, index)
+
+		return Index(index)
+
+	def projects(self):
+		if self.projectForName is None:
+			self.projectForName = dict()
+			for i, local in enumerate(self.local):
+				flags = int(self.flags[i])
+				self.projectForName[local] = IndexedProject(self.names[i], local, self.remote[i] or None, self.sync[i],
+						bool(flags & 1), bool(flags & 2), self.clients.get(i))
+		return self.projectForName
+
+
+class PathIndex:
+	# trie over path components, a node holding kPath is a project
+	kPath = ''
+
+	def __init__(self):
+		self.root = dict()
+
+	def __split(path):
+		return [] if path == os.curdir else path.split(os.sep)
+
+	def __anyPath(node):
+		while not PathIndex.kPath in node:
+			node = next(iter(node.values()))
+		return node[PathIndex.kPath]
+
+	def add(self, path):
+		node = self.root
+		for name in PathIndex.__split(path):
+			if PathIndex.kPath in node:
+				raise ValueError('Conflicting project paths:', node[PathIndex.kPath], path)
+			node = node.setdefault(name, dict())
+
+		if PathIndex.kPath in node:
+			raise ValueError('Duplicated project path:', path)
+		if node:
+			raise ValueError('Conflicting project paths:', PathIndex.__anyPath(node), path)
+
+		node[PathIndex.kPath] = path
+
+
+class History:
+	# durations and imported revision counts of previous downloads
+	kFile = 'p4-history.json'
+
+	def __init__(self, file):
+		self.file = file
+		try:
+			with open(file, 'r') as f:
+				self.entries = json.load(f)
+		except (OSError, ValueError):
+			self.entries = dict()
+
+	def duration(self, path):
+		entry = self.entries.get(path)
+		return entry['duration'] if entry else None
+
+	def record(self, task):
+		self.entries[task.path] = {
+			'duration': round(task.duration(), 3),
+			'revisions': task.progress.imported,
+			'time': int(time.time()),
+		}
+
+	def save(self):
+		tmp = f'{self.file}.{os.getpid()}.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self.entries, f, indent=1, sort_keys=True)
+		os.replace(tmp, self.file)
+
+
+class RetryPolicy:
+	kPermanent = 'permanent'
+	kTransient = 'transient'
+
+	# errors which will not go away by trying again
+	kPermanentErrors = re.compile('|'.join([
+		r'P4PASSWD\) invalid or unset',
+		r'Access for user .* has not been enabled',
+		r"You don't have permission",
+		r'no such file\(s\)',
+		r'must refer to client',
+		r'not in client view',
+		r'[Ii]nvalid depot path',
+		r'Client .* unknown',
+		r'[Uu]nknown command',
+	]))
+
+	def __init__(self, maxTries, baseDelay=2, maxDelay=120):
+		self.maxTries = maxTries
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+
+	def classify(self, error):
+		# anything not known to be permanent (connection drops, timeouts,
+		# busy server) is worth another try
+		if error and RetryPolicy.kPermanentErrors.search(error):
+			return RetryPolicy.kPermanent
+		return RetryPolicy.kTransient
+
+	def shouldRetry(self, task):
+		if task.tryCount + 1 >= self.maxTries:
+			return False
+		return self.classify(task.lastError) == RetryPolicy.kTransient
+
+	def delay(self, tryCount):
+		# exponential backoff with full jitter
+		return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** tryCount))
+
+
+class SshConnection:
+	# one multiplexed ssh connection shared by all gerrit and git calls to a
+	# host, sshd allows 10 sessions per connection by default
+	kMaxSessions = 8
+
+	def __init__(self, host, maxSessions):
+		self.host = host
+		self.semaphore = threading.BoundedSemaphore(max(1, maxSessions))
+		self.controlDir = None
+		self.options = []
+
+		# the Windows ssh client has no connection sharing
+		if sys.platform != 'win32':
+			self.controlDir = tempfile.mkdtemp(prefix='depo-ssh-')
+			self.options = ['-o', 'ControlMaster=auto',
+					'-o', 'ControlPath=' + os.path.join(self.controlDir, '%C'),
+					'-o', 'ControlPersist=60']
+
+	def session(self):
+		return self.semaphore
+
+	def command(self):
+		return ['ssh'] + self.options
+
+	def gitEnv(self):
+		env = dict(os.environ)
+		env['GIT_SSH_COMMAND'] = ' '.join(shlex.quote(a) for a in self.command())
+		env['GIT_SSH_VARIANT'] = 'ssh'
+		return env
+
+	def close(self):
+		if self.controlDir:
+			try:
+				subprocess.run(self.command() + ['-O', 'exit', self.host],
+						stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+			except (OSError, subprocess.TimeoutExpired):
+				pass
+			finally:
+				shutil.rmtree(self.controlDir, ignore_errors=True)
+				self.controlDir = None
+
+
+class Progress:
+	# drains both pipes of a git p4 child while it runs, keeping counters
+	# and only the last lines of each stream for error reports
+	kReadSize = 65536
+	kTailLines = 100
+	kMaxLineLength = 4096
+	kImportingRe = re.compile(r'^Importing revision (\d+)(?: \((\d+)%\))?')
+
+	def __init__(self):
+		self.stdout = collections.deque(maxlen=Progress.kTailLines)
+		self.stderr = collections.deque(maxlen=Progress.kTailLines)
+		self.imported = 0
+		self.revision = None
+		self.percent = None
+		self.lineCount = 0
+		self.size = 0
+
+	async def __readLines(self, stream, onLine):
+		# git p4 reports progress with carriage returns, split on both
+		decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+		pending = ''
+		while True:
+			chunk = await stream.read(Progress.kReadSize)
+			self.size += len(chunk)
+			lines = (pending + decoder.decode(chunk, final=not chunk)).replace('\r', '\n').split('\n')
+			pending = lines.pop()
+			if len(pending) > Progress.kMaxLineLength:
+				# never buffer an unterminated line without bounds
+				lines.append(pending)
+				pending = ''
+			for line in lines:
+				if line:
+					onLine(line[:Progress.kMaxLineLength])
+			if not chunk:
+				break
+		if pending:
+			onLine(pending)
 
-		tree = trees.pop()
+	async def capture(self, stdout, stderr, onStdout):
+		await asyncio.gather(
+				self.__readLines(stdout, onStdout),
+				self.__readLines(stderr, self.onStderr))
 
-		for p in tree.projectForName.values():
-			path = p.localPath()
-			if path in projectForName:
-				raise ValueError('Duplicated project path:', path)
-			for ep in projectForName.keys():
-				if not os.path.relpath(ep, path).startswith('..') or \
-						not os.path.relpath(path, ep).startswith('..'):
-					raise ValueError('Conflicting project paths:', ep, path)
-			projectForName[path] = p
+	def onStdout(self, line):
+		# returns True when the counters changed
+		self.lineCount += 1
+		self.stdout.append(line)
 
-		Tree.__parseTrees(trees + list(tree.treeForName.values()), projectForName)
+		m = Progress.kImportingRe.match(line)
+		if not m:
+			return False
+
+		self.imported += 1
+		self.revision = int(m.group(1))
+		self.percent = int(m.group(2)) if m.group(2) else None
+		return True
+
+	def onStderr(self, line):
+		self.lineCount += 1
+		self.stderr.append(line)
+
+	def text(self):
+		if self.revision is None:
+			return ''
+		return f'Importing revision {self.revision}' + (f' ({self.percent}%)' if self.percent is not None else '')
 
 
 class Task:
-	def __init__(self, config, project, tryCount, error):
+
+	def __init__(self, config, project, tryCount, error, onChange=None):
 		self.config = config
 		self.project = project
 		self.tryCount = tryCount
 		self.lastError = error
+		self.onChange = onChange
 
 		self.process = None
 
@@ -146,6 +478,15 @@ class Task:
 		self.report = False
 
 		self.status = None
+		self.progress = Progress()
+
+		self.startTime = None
+		self.endTime = None
+
+	def duration(self):
+		if self.startTime is None:
+			return 0
+		return (self.endTime if self.endTime is not None else time.monotonic()) - self.startTime
 
 	def dprint(self, *args):
 		if kDebugTasks:
@@ -154,48 +495,62 @@ class Task:
 	def isCompleted(self):
 		return not self.process or self.process.returncode != None
 
-	def __thread(self):
-		for line in self.process.stdout:
-			self.q.put(line)
+	def __changed(self):
+		if self.onChange:
+			self.onChange()
 
-	def __collectErrorStatus(self, proc):
-		return f'error (out={proc.stdout.read()}\n\n err={proc.stderr.read()}\n\n)'
+	def __collectErrorStatus(self, out, err):
+		return f'error (out={out}\n\n err={err}\n\n)'
+
+	def __onStdout(self, line):
+		self.dprint('line:', line)
+		if self.progress.onStdout(line):
+			self.status = self.operationName() + '... ' + self.progress.text()
+			self.__changed()
+
+	async def run(self, dry):
+		self.startTime = time.monotonic()
+		try:
+			await self.__run(dry)
+		finally:
+			self.endTime = time.monotonic()
+
+	async def __run(self, dry):
+		loop = asyncio.get_running_loop()
 
-	def run(self, dry):
 		self.git = Git(os.path.abspath(self.path + '.git'))
-		self.importedCount = 0
 
 		self.isCloning = not os.path.exists(self.git.dir)
-		#print(self.git.dir, 'cloning:', self.isCloning)
 
 		self.status = 'starting'
 
-		def git_run(args):
-			nonlocal dry
+		async def git_run(args):
 			if dry:
 				print(f'would call: {" ".join(args)}')
 			else:
-				nonlocal self
-				self.git.run(args)
+				await loop.run_in_executor(None, self.git.run, args)
 
-		def git_popen(args):
-			nonlocal dry
+		async def git_popen(args):
 			if dry:
 				print(f'would call: {" ".join(args)}')
 			else:
-				nonlocal self
-				return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+				self.processArgs = args
+				self.processStart = time.time_ns()
+				return await asyncio.create_subprocess_exec(*args,
+						stdin=asyncio.subprocess.DEVNULL,
+						stdout=asyncio.subprocess.PIPE,
+						stderr=asyncio.subprocess.PIPE)
 
 		try:
 			if self.isCloning:
 				os.makedirs(self.git.dir)
 
-				git_run(['init', '--bare'])
-				git_run(['config', 'git-p4.user', self.config['user']])
-				git_run(['config', 'git-p4.port', self.config['port']])
+				await git_run(['init', '--bare'])
+				await git_run(['config', 'git-p4.user', self.config['user']])
+				await git_run(['config', 'git-p4.port', self.config['port']])
 
 				if self.project.client:
-					git_run(['config', 'git-p4.client', self.project.client])
+					await git_run(['config', 'git-p4.client', self.project.client])
 
 				depotPath = self.project.remotePath()
 
@@ -205,16 +560,16 @@ class Task:
 				clientArgs = ['--use-client-spec'] if self.project.client else []
 
 				self.dprint(f'doing p4 sync: clientArgs={clientArgs} depotPath={depotPath}')
-				self.process = git_popen(['git', '-C', self.git.dir, 'p4', 'sync'] + clientArgs + [depotPath])
+				self.process = await git_popen(['git', '-C', self.git.dir, 'p4', 'sync'] + clientArgs + [depotPath])
 			else:
-				git_run(['config', 'git-p4.user', self.config['user']])
-				git_run(['config', 'git-p4.port', self.config['port']])
+				await git_run(['config', 'git-p4.user', self.config['user']])
+				await git_run(['config', 'git-p4.port', self.config['port']])
 
-				self.fetchBegin = self.git.commitId('refs/remotes/p4/master')
+				self.fetchBegin = await loop.run_in_executor(None, self.git.commitId, 'refs/remotes/p4/master')
 
-				self.process = git_popen(['git', '-C', self.git.dir, 'p4', 'sync'])
+				self.process = await git_popen(['git', '-C', self.git.dir, 'p4', 'sync'])
 		except subprocess.CalledProcessError as e:
-			self.lastError = self.__collectErrorStatus(e)
+			self.lastError = self.__collectErrorStatus(e.stdout, e.stderr)
 			self.dprint('lastError:', self.lastError)
 			self.completed = True
 
@@ -226,13 +581,54 @@ class Task:
 		if dry:
 			self.completed = True
 			self.ok = True
+			return
+
+		self.status = self.operationName() + '...'
+		self.__changed()
+
+		# both pipes are drained while the process runs and the task wakes
+		# up as soon as it exits
+		await self.progress.capture(self.process.stdout, self.process.stderr, self.__onStdout)
+		await self.process.wait()
+
+		if tracing.tracer is not None:
+			tracing.tracer.record('git p4 sync', self.processArgs, self.git.dir, self.processStart,
+					(time.time_ns() - self.processStart) / 1000000000, self.process.returncode, self.progress.size)
+
+		self.dprint('done', self.process.returncode)
+
+		if self.process.returncode != 0:
+			self.lastError = self.__collectErrorStatus('\n'.join(self.progress.stdout), '\n'.join(self.progress.stderr))
+			self.completed = True
+
+			# a retry has to clone again rather than fetch into a half imported repository
+			if self.isCloning and os.path.exists(self.git.dir):
+				shutil.rmtree(self.git.dir)
+			return
+
+		await loop.run_in_executor(None, self.__complete)
+
+	def __complete(self):
+		# move the master branch to p4/master
+		p4MasterCommitId = self.git.commitId('refs/remotes/p4/master')
+		with open(os.path.join(self.git.dir, 'refs/heads/master'), 'w') as f:
+			print(p4MasterCommitId, file=f)
+
+		self.status = self.operationName() + '... DONE'
+
+		if self.isCloning:
+			self.report = True
 		else:
-			self.q = queue.Queue()
-			self.thread = threading.Thread(target=Task.__thread, args=(self,))
-			self.thread.daemon = True
-			self.thread.start()
+			fetchCount = len(self.git.run(['log', '--oneline',
+					self.fetchBegin + '..refs/remotes/p4/master'])
+					.stdout.splitlines())
 
-			self.status = self.operationName() + '...'
+			if fetchCount != 0:
+				self.status += f' ({fetchCount})'
+				self.report = True
+
+		self.ok = True
+		self.completed = True
 
 	def operationName(self):
 		op = 'cloning' if self.isCloning else 'fetching'
@@ -242,58 +638,11 @@ class Task:
 			op += f' error={self.lastError}';
 		return op
 
-	def update(self):
-		if self.process == None: return
-
-		try:
-			self.dprint('waiting for...', self.project.localPath())
-			self.process.wait(timeout=1)
-			self.dprint('waiting for...', self.project.localPath(), 'done', self.process.returncode)
-
-			if self.process.returncode != None:
-				if self.process.returncode != 0:
-					self.lastError = self.__collectErrorStatus(self.process)
-					self.completed = True
-				else:
-					# move the master branch to p4/master
-					p4MasterCommitId = self.git.commitId('refs/remotes/p4/master')
-					with open(os.path.join(self.git.dir, 'refs/heads/master'), 'w') as f:
-						print(p4MasterCommitId, file=f)
-
-					self.status = self.operationName() + '... DONE'
-
-					if self.isCloning:
-						self.report = True
-					else:
-						fetchCount = len(self.git.run(['log', '--oneline',
-								self.fetchBegin + '..refs/remotes/p4/master'])
-								.stdout.splitlines())
-
-						if fetchCount != 0:
-							self.status += f' ({fetchCount})'
-							self.report = True
-
-					self.ok = True
-					self.completed = True
-		except subprocess.TimeoutExpired:
-			self.dprint('waiting for...', self.project.localPath(), 'timeout', self.process.stdout)
-			self.dprint('reading...')
-
-			try:
-				while True:
-					line = self.q.get_nowait() # or q.get(timeout=.1)
-					self.dprint('line:', line)
-					if line.startswith('Importing revision'):
-						self.importedCount += 1
-						self.status = self.operationName() + '... ' + line.rstrip()
-			except queue.Empty:
-				self.dprint('no output yet')
-
-			self.dprint('waiting for...', self.project.localPath(), 'timeout done')
-
 
 class Main:
 	kMaxTasks = 8
+	kMaxTries = 5
+	kRedrawInterval = 0.1
 
 	def __init__(self):
 		parser = argparse.ArgumentParser()
@@ -301,6 +650,7 @@ class Main:
 		parser.add_argument('--upload', required=False, action='store_true')
 		parser.add_argument('-j', required=False, type=int, default=Main.kMaxTasks)
 		parser.add_argument('-n', required=False, action='store_true')
+		parser.add_argument('--max-tries', dest='max_tries', required=False, type=int, default=Main.kMaxTries)
 		parser.add_argument('projects', nargs='*')
 		self.args = parser.parse_args()
 
@@ -308,10 +658,9 @@ class Main:
 		self.doDownload = True if useDefaultSyncFlags else self.args.download
 		self.doUpload = True if useDefaultSyncFlags else self.args.upload
 
-		with open('config.json', 'r') as configFile:
-			self.config = json.loads(configFile.read())
-
-		self.projectForPath = Tree.load(self.config)
+		index = Index.load('config.json')
+		self.config = index.settings
+		self.projectForPath = index.projects()
 
 		unknownProjectNames = [p for p in self.args.projects if p not in self.projectForPath]
 		if unknownProjectNames:
@@ -321,45 +670,78 @@ class Main:
 		print(f'{task.prefix} {task.status}')
 		sys.stdout.flush()
 
-	def updateTasks(self):
-		needUpdate = False
+	def notify(self):
+		self.changed.set()
 
-		completedTasks = []
+	async def runProject(self, project, tryCount, lastError):
+		task = Task(self.config, project, tryCount, lastError, self.notify)
+		print("task:", task.path)
+		self.tasks.append(task)
 
-		for task in self.tasks[:]:
-			oldStatus = task.status
-			task.update()
+		await task.run(self.args.n)
 
-			if task.completed:
-				if not task.ok:
-					taskIndex = self.tasks.index(task)
-					self.tasks.remove(task)
-					task = Task(self.config, task.project, task.tryCount + 1, task.lastError)
-					task.run(self.args.n)
-					self.tasks.insert(taskIndex, task)
-				else:
-					self.tasks.remove(task)
-					completedTasks.append(task)
-				needUpdate = True
-			else:
-				needUpdate |= task.status != oldStatus
+		self.tasks.remove(task)
 
-		for i in range(len(self.tasks), self.args.j):
-			if not self.remainingProjects:
+		if task.ok:
+			if not self.args.n:
+				self.history.record(task)
+		elif self.retryPolicy.shouldRetry(task):
+			# retry later and let healthy projects use the slot meanwhile
+			readyTime = time.monotonic() + self.retryPolicy.delay(task.tryCount)
+			heapq.heappush(self.deferredProjects, (readyTime, next(self.deferredCounter), project, task.tryCount + 1, task.lastError))
+			self.notify()
+			return
+		else:
+			self.failedTasks.append(task)
+
+		self.finishedTasks.append(task)
+		self.notify()
+
+	def nextProject(self):
+		if self.deferredProjects and self.deferredProjects[0][0] <= time.monotonic():
+			_, _, project, tryCount, lastError = heapq.heappop(self.deferredProjects)
+			return project, tryCount, lastError
+
+		while self.remainingProjects:
+			project = self.remainingProjects.pop()
+			if not self.args.projects or project.localPath() in self.args.projects:
+				return project, 0, None
+
+	async def worker(self):
+		# a slot is refilled as soon as its task finishes
+		while True:
+			project = self.nextProject()
+			if project:
+				await self.runProject(*project)
+			elif self.deferredProjects:
+				await asyncio.sleep(max(0, self.deferredProjects[0][0] - time.monotonic()))
+			else:
 				break
 
-			task = Task(self.config, self.remainingProjects.pop(), 0, None)
+	async def downloadTasks(self):
+		self.changed = asyncio.Event()
 
-			if self.args.projects and task.project.localPath() not in self.args.projects:
-				completedTasks.append(task)
-			else:
-				print("task:", task.path)
-				self.tasks.append(task)
-				task.run(self.args.n)
+		workers = asyncio.gather(*[self.worker() for _ in range(max(1, self.args.j))])
+		workers.add_done_callback(lambda _: self.notify())
+
+		while True:
+			await self.changed.wait()
+			self.changed.clear()
 
-			needUpdate = True
+			completedTasks = self.finishedTasks
+			self.finishedTasks = []
 
-		return needUpdate, completedTasks
+			self.eraseTaskLog()
+			self.completeTasks(completedTasks)
+			self.printTaskLog()
+
+			if workers.done():
+				break
+
+			# coalesce progress updates, completions never wait on this
+			await asyncio.sleep(Main.kRedrawInterval)
+
+		await workers
 
 	def eraseTaskLog(self):
 		if kDebugTasks:
@@ -384,9 +766,25 @@ class Main:
 
 		print()
 		print('-' * 40)
-		print(f'Working: {self.processedTaskCount}/{self.totalTaskCount}')
+		deferred = f' deferred: {len(self.deferredProjects)}' if self.deferredProjects else ''
+		failed = f' failed: {len(self.failedTasks)}' if self.failedTasks else ''
+		print(f'Working: {self.processedTaskCount}/{self.totalTaskCount}{self.eta()}{deferred}{failed}')
 		print()
 
+	def expectedDuration(self, project):
+		duration = self.history.duration(project.localPath())
+		return self.defaultDuration if duration is None else duration
+
+	def eta(self):
+		if not self.defaultDuration:
+			return ''
+
+		# remaining expected work spread over the slots
+		work = sum(self.expectedDuration(p) for p in self.remainingProjects) \
+				+ sum(max(0, self.expectedDuration(t.project) - t.duration()) for t in self.tasks)
+		seconds = int(work / max(1, self.args.j))
+		return f' ETA: {seconds // 60}m{seconds % 60:02d}s'
+
 	def printTaskLog(self):
 		for task in self.tasks:
 			self.printTask(task)
@@ -408,47 +806,77 @@ class Main:
 
 			sources = [get_source(s) for s in config['sources']]
 
+		printLock = threading.Lock()
+
+		def log(*args):
+			with printLock:
+				print(*args)
+				sys.stdout.flush()
+
 		def gexec(command, *args):
-			nonlocal host
-			return subprocess.run(['ssh', host, 'gerrit', command, *args], \
-					stdout=subprocess.PIPE,
-					universal_newlines=True,
-					check=True).stdout
-
-		# get list of all projects
-		allGerritProjects = gexec('ls-projects').splitlines()
-		print('all gerrit projects:', allGerritProjects)
-
-		for project in list(self.projectForPath.values()):
-			path = project.localPath()
-
-			def find_source():
-				nonlocal sources, path
-
-				for source in sources:
-					if path == source.fromdir:
-						todir = source.todir
-					elif path.startswith(source.fromdir + '/'):
-						todir = source.todir + '/' + path[len(source.fromdir) + 1:]
-					else:
-						todir = None
-
-					if todir != None:
-						return todir, source.branch
+			with ssh.session():
+				return subprocess.run(ssh.command() + [host, 'gerrit', command, *args], \
+						stdout=subprocess.PIPE,
+						stderr=subprocess.PIPE,
+						universal_newlines=True,
+						check=True).stdout
+
+		def find_source(path):
+			for source in sources:
+				if path == source.fromdir:
+					todir = source.todir
+				elif path.startswith(source.fromdir + '/'):
+					todir = source.todir + '/' + path[len(source.fromdir) + 1:]
 				else:
-					raise LookupError()
+					todir = None
+
+				if todir != None:
+					return todir, source.branch
+			else:
+				raise LookupError()
 
+		def ls_remote(todir, branch):
 			try:
-				todir, branch = find_source()
-			except LookupError:
-				print(f'Project not exported: {path}')
-				continue
+				with ssh.session():
+					return Git().run(['ls-remote', '--exit-code', 'ssh://' + host + '/' + todir, branch],
+							env=ssh.gitEnv()).stdout.split(maxsplit=1)[0]
+			except (subprocess.CalledProcessError, OSError):
+				# unknown head, the project is pushed anyway
+				return None
+
+		def remote_heads(pool, jobs):
+			# heads of all exported branches with a single gerrit query,
+			# asking each repository in parallel if the server can not do it
+			branches = sorted(set(branch for _, _, branch in jobs))
+			heads = dict()
 
+			try:
+				output = gexec('ls-projects', *[a for branch in branches for a in ('--show-branch', branch)])
+			except subprocess.CalledProcessError:
+				output = None
+
+			if output is not None:
+				for line in output.splitlines():
+					tokens = line.split(' ', len(branches))
+					if len(tokens) != len(branches) + 1:
+						continue
+					for branch, commitId in zip(branches, tokens):
+						if not commitId.startswith('-'):
+							heads[(tokens[-1], branch)] = commitId
+				return heads
+
+			keys = [(todir, branch) for _, todir, branch in jobs if todir in allGerritProjects]
+			for key, commitId in zip(keys, pool.map(lambda key: ls_remote(*key), keys)):
+				if commitId:
+					heads[key] = commitId
+			return heads
+
+		def upload_project(path, todir, branch):
 			exists = todir in allGerritProjects
 
-			print(f'project: from={path} to={todir} exists={exists}')
+			log(f'project: from={path} to={todir} exists={exists}')
 
-			if dry: continue
+			if dry: return
 
 			# create project on gerrit if it is not exist
 			if not exists:
@@ -459,47 +887,105 @@ class Main:
 
 			gitUrl = 'ssh://' + host + '/' + todir
 
-			# fetch changes from remote repository
-			git = Git(os.path.abspath(path + '.git'))
+			git = Git(os.path.abspath(path + '.git'), direct=True)
 			localId = git.commitId('refs/remotes/p4/master')
 
-			try:
-				remoteId = git.run(['ls-remote', '--exit-code', gitUrl, branch]).stdout.split(maxsplit=1)[0]
-				if remoteId == localId:
-					# nothing to upload, skip
-					continue
-			except subprocess.CalledProcessError as e:
-				# no remote id, this is ok, create a new branch
-				pass
+			if remoteHeads.get((todir, branch)) == localId:
+				# nothing to upload, skip
+				return
+
+			# no remote id is ok too, this creates a new branch
+			with ssh.session():
+				git.run(['push', '-o', 'skip-validation', gitUrl, localId + ':' + branch], env=ssh.gitEnv())
 
-			git.run(['push', '-o', 'skip-validation', gitUrl, localId + ':' + branch])
+		ssh = SshConnection(host, config.get('connections', SshConnection.kMaxSessions))
+		try:
+			# get list of all projects
+			allGerritProjects = set(gexec('ls-projects').splitlines())
+			print('all gerrit projects:', sorted(allGerritProjects))
+
+			jobs = []
+			for project in list(self.projectForPath.values()):
+				path = project.localPath()
+
+				try:
+					todir, branch = find_source(path)
+				except LookupError:
+					print(f'Project not exported: {path}')
+					continue
 
+				jobs.append((path, todir, branch))
+
+			with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.args.j)) as pool:
+				remoteHeads = remote_heads(pool, jobs) if jobs and not dry else dict()
+
+				futures = {pool.submit(upload_project, *job): job[0] for job in jobs}
+				for future in concurrent.futures.as_completed(futures):
+					try:
+						future.result()
+					except subprocess.CalledProcessError as e:
+						log(f'Upload failed: {futures[future]}: {e.cmd} (exit code: {e.returncode})\n{e.stderr}')
+						self.failedUploads.append(futures[future])
+					except Exception as e:
+						# ssh or git missing, timeouts, ... only fail this project
+						log(f'Upload failed: {futures[future]}: {e!r}')
+						self.failedUploads.append(futures[future])
+		finally:
+			ssh.close()
 
 	def download(self):
+		self.history = History(History.kFile)
+
 		self.remainingProjects = [p for p in list(self.projectForPath.values()) if p.enabled]
+
+		# longest expected downloads first, projects without history are
+		# assumed to be as long as the longest known one
+		known = [d for d in (self.history.duration(p.localPath()) for p in self.remainingProjects) if d is not None]
+		self.defaultDuration = max(known) if known else 0
+		self.remainingProjects.sort(key=self.expectedDuration)
+
 		self.completedTasks = []
 		self.processedTaskCount = 0
 		self.totalTaskCount = len(self.args.projects) if self.args.projects else len(self.remainingProjects)
 		self.visibleTasks = []
 		self.grandLineCount = 0
 		self.tasks = []
+		self.finishedTasks = []
+		self.failedTasks = []
+		self.deferredProjects = []
+		self.deferredCounter = itertools.count()
+		self.retryPolicy = RetryPolicy(self.args.max_tries)
 
 		print('-' * 40)
 
-		while self.tasks or self.remainingProjects:
-			needUpdate, completedTasks = self.updateTasks()
-
-			if needUpdate:
-				self.eraseTaskLog()
-				self.completeTasks(completedTasks)
-				self.printTaskLog()
+		try:
+			asyncio.run(self.downloadTasks())
+		finally:
+			if not self.args.n:
+				self.history.save()
 
 	def exec(self):
+		failedTasks = []
+		self.failedUploads = []
+		if tracing.tracer is not None:
+			tracing.reset(tracing.tracer.dir)
 		if self.doDownload:
 			self.download()
+			failedTasks = self.failedTasks
 		if self.doUpload:
 			self.upload(self.args.n)
 
+		if tracing.tracer is not None:
+			tracing.tracer.save()
+			tracing.report(tracing.tracer.dir)
+
+		if failedTasks:
+			print(f'Failed projects: {" ".join(t.path for t in failedTasks)}', file=sys.stderr)
+		if self.failedUploads:
+			print(f'Failed uploads: {" ".join(self.failedUploads)}', file=sys.stderr)
+		if failedTasks or self.failedUploads:
+			sys.exit(1)
+
 if __name__ == '__main__':
 	try:
 		Main().exec()
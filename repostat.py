@@ -2,7 +2,7 @@
 import os
 from git import Git
 import colorize
-import subprocess
+from manifest import Project
 
 class Commit:
 	def __init__(self, log):
@@ -16,12 +16,15 @@ class Stat:
 
 	filters = [do_not_merge_filter]
 
-	def __init__(self, merges=True, commits=True):
-		self.git = Git()
+	def __init__(self, merges=True, commits=True, project=None):
+		if project is None:
+			project = Project.fromEnv()
 
-		self.remote = os.environ['REPO_REMOTE']
-		self.path = os.environ['REPO_PATH']
-		self.rrev = os.environ['REPO_RREV']
+		self.git = Git(project.dir, batch=True, direct=True)
+
+		self.remote = project.remote
+		self.path = project.path
+		self.rrev = project.rrev
 
 		self.branch_name = None
 		self.is_tracking = False
@@ -29,8 +32,10 @@ class Stat:
 		is_rrev_ref = self.rrev.startswith('refs/')
 		is_rrev_ref_heads = is_rrev_ref and self.rrev.startswith('refs/heads/')
 
-		self.remote_revision = self.git.valid_remote_revision(self.remote, self.rrev)
-		self.remote_local_revision = self.git.remote_local_revision(self.rrev)
+		refs = self.git.refs()
+
+		self.remote_revision = self.git.valid_remote_revision(self.remote, self.rrev, refs)
+		self.remote_local_revision = self.git.remote_local_revision(self.rrev, refs)
 
 		if commits:
 			self.no_remote_revision = False
@@ -54,18 +59,15 @@ class Stat:
 			else:
 				self.filtered_revs = [c.hash for c in self.commits for f in Stat.filters if not f(c)]
 
-			self.dirty_files = self.git.run(['status', '-s'], color=True).stdout.splitlines()
+			self.dirty_files = self.git.run(['status', '-s'], color=colorize.enabled).stdout.splitlines()
 
 			self.has_info = self.no_remote_revision or self.commits or self.dirty_files or self.filtered_revs
 
-			if self.has_info:
-				# resolve branch name and tracking flag
-				if self.git.run(['rev-parse', '--symbolic-full-name', 'HEAD']).stdout.strip() != 'HEAD':
-					self.branch_name = self.git.run(['rev-parse', '--abbrev-ref=loose', 'HEAD']).stdout.strip()
-
-					try:
-						branch_remote = self.git.run(['config', 'branch.' + self.branch_name + '.remote']).stdout.strip()
-						branch_merge = self.git.run(['config', 'branch.' + self.branch_name + '.merge']).stdout.strip()
-						self.is_tracking = branch_remote == self.remote and branch_merge == self.remote_local_revision
-					except subprocess.CalledProcessError:
-						pass
+			# resolve branch name and tracking flag, cheap with the refs snapshot
+			head = refs.headRef()
+			if head is not None:
+				self.branch_name = Git.branchForName(head)
+
+				branch_remote = refs.config('branch.' + self.branch_name + '.remote')
+				branch_merge = refs.config('branch.' + self.branch_name + '.merge')
+				self.is_tracking = branch_remote == self.remote and branch_merge == self.remote_local_revision
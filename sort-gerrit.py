@@ -1,21 +1,119 @@
 #!/usr/bin/env python3
 
 import sys
+import heapq
+import argparse
+import tempfile
 
 change_prefix = 'refs/changes/'
 
-def keyfunc(s):
-	ch = s.split('\t', maxsplit=1)[1].strip()
-	if not ch.startswith(change_prefix):
-		return s
-	index, ps = ch[len(change_prefix) + 3:].split('/')
-	return index.rjust(8, '0') + ps.rjust(4, '0')
+# lines held in memory before sorted runs are spilled to temporary files
+max_buffered_lines = 1000000
 
-lines = []
-for line in sys.stdin:
-	lines.append(line)
 
-sorted_lines = sorted(lines, key=keyfunc)
+def parse(line):
+	# (sha, change, patchset) for patchset refs, None for anything else
+	sha, _, ref = line.partition('\t')
+	ref = ref.strip()
+	if not ref.startswith(change_prefix):
+		return None
+	parts = ref[len(change_prefix):].split('/')
+	if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+		return None
+	return sha, int(parts[1]), int(parts[2])
 
-for line in sorted_lines:
-	print(line, end='')
+
+def keyfunc(line):
+	# patchsets by change and patchset number, other refs after them
+	p = parse(line)
+	if p is None:
+		return (1, 0, 0, line)
+	return (0, p[1], p[2], '')
+
+
+def format_change(sha, change, ps):
+	return f'{sha}\t{change_prefix}{change % 100:02d}/{change}/{ps}\n'
+
+
+def sort_all(lines, out, buffer_size):
+	runs = []
+	chunk = []
+
+	def spill():
+		run = tempfile.TemporaryFile('w+')
+		run.writelines(sorted(chunk, key=keyfunc))
+		run.seek(0)
+		runs.append(run)
+		chunk.clear()
+
+	for line in lines:
+		if not line.endswith('\n'):
+			line += '\n'
+		chunk.append(line)
+		if len(chunk) >= buffer_size:
+			spill()
+
+	if not runs:
+		out.writelines(sorted(chunk, key=keyfunc))
+		return
+
+	if chunk:
+		spill()
+	out.writelines(heapq.merge(*runs, key=keyfunc))
+	for run in runs:
+		run.close()
+
+
+def latest_patchsets(lines, top=None):
+	# change -> (patchset, sha), with top only the highest top changes are
+	# kept, their numbers in a min-heap so a lower change is dropped at once
+	latest = dict()
+	heap = []
+	if top is not None and top <= 0:
+		return latest
+
+	for line in lines:
+		p = parse(line)
+		if p is None:
+			continue
+		sha, change, ps = p
+
+		current = latest.get(change)
+		if current is not None:
+			if ps > current[0]:
+				latest[change] = (ps, sha)
+			continue
+
+		if top is not None:
+			if len(heap) >= top:
+				if change < heap[0]:
+					continue
+				del latest[heapq.heappushpop(heap, change)]
+			else:
+				heapq.heappush(heap, change)
+
+		latest[change] = (ps, sha)
+
+	return latest
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--latest', action='store_true',
+			help='print only the newest patchset of every change')
+	parser.add_argument('--top', type=int,
+			help='print only the newest patchset of the highest numbered changes')
+	parser.add_argument('--buffer-lines', dest='buffer_lines', type=int, default=max_buffered_lines)
+	args = parser.parse_args()
+
+	if args.latest or args.top is not None:
+		latest = latest_patchsets(sys.stdin, args.top)
+		for change in sorted(latest):
+			ps, sha = latest[change]
+			sys.stdout.write(format_change(sha, change, ps))
+	else:
+		sort_all(sys.stdin, sys.stdout, max(1, args.buffer_lines))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import threading
+import subprocess
+
+
+# directory where every process writes its subprocess timings, when set
+kEnv = 'DEPO_TRACE'
+kTopCount = 20
+
+
+class Tracer:
+	def __init__(self, dir):
+		self.dir = dir
+		self.lock = threading.Lock()
+		self.events = []
+
+	def record(self, name, cmd, repository, start, duration, returncode, size):
+		# start is wall clock time so events of separate processes line up
+		event = dict(name=name, cat='subprocess', ph='X',
+				ts=start // 1000, dur=round(duration * 1000000),
+				pid=os.getpid(), tid=threading.get_ident(),
+				args=dict(cmd=' '.join(cmd), repository=repository, returncode=returncode, bytes=size))
+		with self.lock:
+			self.events.append(event)
+
+	def run(self, name, cmd, repository, **kwargs):
+		start = time.time_ns()
+		begin = time.perf_counter()
+		try:
+			r = subprocess.run(cmd, **kwargs)
+		except subprocess.CalledProcessError as e:
+			self.record(name, cmd, repository, start, time.perf_counter() - begin, e.returncode,
+					Tracer.__size(e.stdout) + Tracer.__size(e.stderr))
+			raise
+		self.record(name, cmd, repository, start, time.perf_counter() - begin, r.returncode,
+				Tracer.__size(r.stdout) + Tracer.__size(r.stderr))
+		return r
+
+	def __size(output):
+		# text output is encoded back to count bytes rather than characters
+		if output is None:
+			return 0
+		return len(output.encode(errors='surrogateescape')) if isinstance(output, str) else len(output)
+
+	def save(self):
+		with self.lock:
+			events = list(self.events)
+		if not events:
+			return
+		os.makedirs(self.dir, exist_ok=True)
+		with open(os.path.join(self.dir, f'events-{os.getpid()}.json'), 'w') as f:
+			json.dump(events, f)
+
+
+tracer = None
+
+
+def enable(dir):
+	global tracer
+	if tracer is None:
+		tracer = Tracer(os.path.realpath(dir))
+		atexit.register(tracer.save)
+	return tracer
+
+
+def reset(dir):
+	# drops the events of earlier runs sharing the directory
+	for path in glob.glob(os.path.join(dir, 'events-*.json')):
+		os.remove(path)
+
+
+def report(dir, out=sys.stderr, top=kTopCount):
+	# merges the events of all processes into trace.json for chrome://tracing
+	# and writes the slowest commands and per repository totals to summary.txt
+	events = []
+	for path in sorted(glob.glob(os.path.join(dir, 'events-*.json'))):
+		with open(path) as f:
+			events += json.load(f)
+
+	if not events:
+		return
+
+	with open(os.path.join(dir, 'trace.json'), 'w') as f:
+		json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+	totals = dict()
+	for e in events:
+		repository = e['args']['repository']
+		count, duration, size = totals.get(repository, (0, 0, 0))
+		totals[repository] = (count + 1, duration + e['dur'], size + e['args']['bytes'])
+
+	lines = [f'{len(events)} subprocesses, {sum(e["dur"] for e in events) / 1000000:.3f}s total', '',
+			'Slowest commands:']
+	for e in sorted(events, key=lambda e: e['dur'], reverse=True)[:top]:
+		lines.append(f'{e["dur"] / 1000000:9.3f}s  exit={e["args"]["returncode"]}  {e["args"]["repository"]}: {e["args"]["cmd"]}')
+
+	lines += ['', 'Slowest repositories:']
+	for repository, (count, duration, size) in sorted(totals.items(), key=lambda i: i[1][1], reverse=True)[:top]:
+		lines.append(f'{duration / 1000000:9.3f}s  {count:5d} calls  {size:10d} bytes  {repository}')
+
+	text = '\n'.join(lines) + '\n'
+	with open(os.path.join(dir, 'summary.txt'), 'w') as f:
+		f.write(text)
+
+	print(f'Trace written to: {os.path.join(dir, "trace.json")}', file=out)
+	print(text, end='', file=out)
+
+
+if os.environ.get(kEnv):
+	enable(os.environ[kEnv])